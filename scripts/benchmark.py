@@ -0,0 +1,231 @@
+# Benchmarks for the parsing and aggregation hot paths.
+#
+# Each case is run against synthetic data at several sizes and reports the
+# best wall clock time and the peak memory allocated. Results can be saved as
+# a baseline and later runs compared against it:
+#
+#     python scripts/benchmark.py --save benchmarks/baseline.json
+#     python scripts/benchmark.py --compare benchmarks/baseline.json
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import utils
+from series import Series, Table
+from synthetic import SyntheticApi, SyntheticFleet
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'baseline.json')
+
+DAY = 24 * 60 * 60
+# a fixed window so results don't depend on the day they are run
+BENCH_END = 1577836800  # 2020-01-01
+
+
+class _MemoryApi(SyntheticApi):
+    """Synthetic API that keeps its responses so only the first call pays for generating them"""
+    def __init__(self, fleet):
+        super(_MemoryApi, self).__init__(fleet)
+        self.responses = {}
+
+    def replay(self, func, args, kwargs):
+        key = json.dumps([func.__name__, args, kwargs], sort_keys=True, default=str)
+        if key not in self.responses:
+            self.responses[key] = super(_MemoryApi, self).replay(func, args, kwargs)
+        return self.responses[key]
+
+
+def _pointlist(days):
+    """15 minute request counts over ``days`` days"""
+    fleet = SyntheticFleet()
+    query = 'sum:nginx.requests{environment:bench}.rollup(sum, 900)'
+    step = 900 * utils.MAX_QUERY_POINTS
+    return utils.merge_query_results(
+        fleet.query(start, min(start + step, BENCH_END), query)
+        for start in range(BENCH_END - days * DAY, BENCH_END, step)
+    )['series'][0]['pointlist']
+
+
+def setup_pointlist_by_host(hosts):
+    fleet = SyntheticFleet(hosts=hosts)
+    result = fleet.query(
+        BENCH_END - 7 * DAY, BENCH_END, 'max:system.disk.in_use{environment:bench}by{host,device}.rollup(max, 3600)'
+    )
+    return lambda: utils.get_pointlist_by_host(result, tags=['host', 'device'])
+
+
+def setup_series_store(hosts):
+    fleet = SyntheticFleet(hosts=hosts)
+    result = fleet.query(
+        BENCH_END - 7 * DAY, BENCH_END, 'max:system.disk.in_use{environment:bench}by{host,device}.rollup(max, 3600)'
+    )
+    return lambda: utils.get_pointlist_by_host(result, tags=['host', 'device'], as_store=True).max()
+
+
+def setup_daily_peak(days):
+    from icds_success import _get_daily_max
+    series = Series.from_pointlist(_pointlist(days))
+    day_edges = list(range((BENCH_END - days * DAY) * 1000, BENCH_END * 1000 + 1, DAY * 1000))
+    return lambda: (_get_daily_max(series.split(day_edges)), series.argmax())
+
+
+def setup_rollup_peaks(days):
+    series = Series.from_pointlist(_pointlist(days))
+    return lambda: (
+        series.resample(3600 * 1000).argmax(), series.resample(DAY * 1000).argmax(),
+        series.top(10), series.rolling_sum(3600 * 1000, 900 * 1000).argmax(),
+    )
+
+
+def setup_profile_transpose(days):
+    from request_profile import get_peak_ratios, get_profile, get_slot_percentiles
+    series = Series.from_pointlist(_pointlist(days))
+    start = (BENCH_END - days * DAY) * 1000
+    windows = [(start + i * DAY * 1000, start + (i + 1) * DAY * 1000) for i in range(days)]
+
+    def run():
+        matrix = get_profile(series, windows, 900)
+        return get_peak_ratios(matrix), get_slot_percentiles(matrix)
+    return run
+
+
+def setup_join(days):
+    fleet = SyntheticFleet()
+    query = ', '.join(
+        'sum:nginx.requests{{environment:bench,status_code:{}}}.rollup(sum, 900)'.format(status_code)
+        for status_code in ('200', '201', '202', '401', '412', '500')
+    )
+    step = 900 * utils.MAX_QUERY_POINTS
+    result = utils.merge_query_results(
+        fleet.query(start, min(start + step, BENCH_END), query)
+        for start in range(BENCH_END - days * DAY, BENCH_END, step)
+    )
+    series = [Series.from_pointlist(item['pointlist'][i % 3:]) for i, item in enumerate(result['series'])]
+    return lambda: list(Table.join(series).iter_rows(value_format='%d', missing='---'))
+
+
+def setup_format_epochs(hosts):
+    from const import ENV_TZ
+    fleet = SyntheticFleet(hosts=hosts)
+    result = fleet.query(BENCH_END - 30 * DAY, BENCH_END, 'max:system.mem.used{environment:swiss}by{host}.rollup(max, 3600)')
+    timestamps = [ts for series in result['series'] for ts, _ in series['pointlist']]
+    return lambda: utils.format_epochs(timestamps, ENV_TZ['swiss'], '%Y-%m-%d %H:%M')
+
+
+class _FrozenTime(object):
+    """Stand in for the ``time`` module that is stopped at ``BENCH_END``"""
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def time(self):
+        return BENCH_END
+
+
+@contextmanager
+def _patched(obj, name, value):
+    previous = getattr(obj, name)
+    setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        setattr(obj, name, previous)
+
+
+def setup_machine_usage(hosts):
+    import machine_sizes
+    store = _MemoryApi(SyntheticFleet(hosts=hosts))
+    machine_sizes.get_host_stats.cache_clear()  # the hosts of a smaller size
+
+    def run():
+        with _patched(utils, '_replay_store', store), _patched(machine_sizes, 'time', _FrozenTime()):
+            return machine_sizes.get_host_usage_stats('bench', 7, None)
+    run()  # generate and keep the responses
+    return run
+
+
+def setup_inline_diff(terms):
+    from rename import inline_diff
+    old = ' + '.join(
+        'sum:formplayer.metrics.requests{{environment:bench,status_code:{}}}.as_count()'.format(200 + i)
+        for i in range(terms)
+    )
+    new = old.replace('formplayer.metrics.requests', 'formplayer.metrics.timings.count')
+    return lambda: inline_diff(old, new)
+
+
+CASES = OrderedDict([
+    ('get_pointlist_by_host', (setup_pointlist_by_host, [10, 100, 1000])),
+    ('series_store_max', (setup_series_store, [10, 100, 1000])),
+    ('icds_daily_peak', (setup_daily_peak, [30, 365, 1825])),
+    ('rollup_peaks', (setup_rollup_peaks, [30, 365, 1825])),
+    ('request_profile_transpose', (setup_profile_transpose, [30, 365, 1825])),
+    ('join_rows', (setup_join, [30, 365, 1825])),
+    ('export_format_epochs', (setup_format_epochs, [10, 100, 1000])),
+    ('machine_sizes_usage', (setup_machine_usage, [10, 100, 1000])),
+    ('rename_inline_diff', (setup_inline_diff, [10, 50, 200])),
+])
+
+
+def measure(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'seconds': min(timings), 'peak_mb': peak / 1024 ** 2}
+
+
+def run_benchmarks(cases, repeat, quick=False):
+    for name in cases:
+        setup, sizes = CASES[name]
+        for size in sizes[:1] if quick else sizes:
+            yield name, size, measure(setup(size), repeat)
+
+
+def _get_args():
+    parser = argparse.ArgumentParser(description='Benchmark the data handling hot paths')
+    parser.add_argument('cases', nargs='*', help='Cases to run, one of: {}. Defaults to all.'.format(', '.join(CASES)))
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Number of timed runs per size.')
+    parser.add_argument('--quick', action='store_true', help='Only run the smallest size of each case.')
+    parser.add_argument('--save', nargs='?', const=DEFAULT_BASELINE, help='Save the results as a baseline.')
+    parser.add_argument('--compare', nargs='?', const=DEFAULT_BASELINE, help='Compare the results to a baseline.')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = _get_args()
+    unknown = set(args.cases) - set(CASES)
+    if unknown:
+        raise SystemExit('Unknown cases: {}'.format(', '.join(sorted(unknown))))
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = OrderedDict()
+    print('{:<28}{:>8}{:>12}{:>12}{:>12}'.format('case', 'size', 'seconds', 'peak MB', 'speedup'))
+    for name, size, result in run_benchmarks(args.cases or list(CASES), args.repeat, args.quick):
+        results.setdefault(name, OrderedDict())[str(size)] = result
+        before = baseline.get(name, {}).get(str(size))
+        speedup = '{:.2f}x'.format(before['seconds'] / result['seconds']) if before else ''
+        print('{:<28}{:>8}{:>12.4f}{:>12.1f}{:>12}'.format(name, size, result['seconds'], result['peak_mb'], speedup))
+
+    if args.save:
+        if not os.path.isdir(os.path.dirname(os.path.abspath(args.save))):
+            os.makedirs(os.path.dirname(os.path.abspath(args.save)))
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -1,38 +1,71 @@
 import argparse
+import json
+import sys
+import tempfile
 from collections import defaultdict
-from datetime import timedelta
 
 import pytz
-from datadog import api
 
-from icds_success import format_epoch
-from utils import arg_date_type
+from utils import arg_date_type, format_epochs
 from utils import get_pointlist_by_host, get_config, init_datadog
+from utils import add_query_args, configure_queries, iter_query_range
 
+OUTPUT_BUFFER_SIZE = 1024 * 1024
 
-def export_metric(query, start_date, end_date):
+
+def export_metric(query, start_date, end_date, output=None):
+    """Export a by host query as CSV with one column per host.
+
+    The host columns aren't known until all the data has been fetched so each
+    window is written to a spill file as it arrives and the CSV is written
+    from that in a final pass. Only one window is held in memory at a time.
+    """
     hosts = set()
-    by_date = defaultdict(dict)
-    while start_date < end_date:
-        end_day = start_date + timedelta(days=1)
-
-        print(f"Collecting data for day {start_date.date()}")
-        mem_stats = get_pointlist_by_host(
-            api.Metric.query(start=start_date.strftime('%s'), end=end_day.strftime('%s'), query=query))
-        hosts |= set(mem_stats)
-        tz = pytz.timezone('Asia/Kolkata')
-        for host, pointlist in mem_stats.items():
-            for ts, value in pointlist:
-                date = format_epoch(ts, tz, '%Y-%m-%d %H:%M')
+    tz = pytz.timezone('Asia/Kolkata')
+    with tempfile.TemporaryFile(mode='w+') as spill:
+        for (window_start, window_end), result in iter_query_range(query, start_date, end_date):
+            print(f"Collecting data for {window_start} to {window_end}")
+            by_date = defaultdict(dict)
+            mem_stats = get_pointlist_by_host(result)
+            hosts |= set(mem_stats)
+            points = [
+                (host, ts, value)
+                for host, pointlist in mem_stats.items()
+                for ts, value in pointlist
+                if value is not None
+            ]
+            dates = format_epochs([ts for _, ts, _ in points], tz, '%Y-%m-%d %H:%M')
+            for date, (host, _, value) in zip(dates, points):
                 by_date[date][host] = str(value / 1024 ** 3)
+            for date in sorted(by_date):
+                spill.write(json.dumps([date, by_date[date]]) + '\n')
+
+        spill.seek(0)
+        hosts = sorted(list(hosts))
+        out = open(output, 'w', buffering=OUTPUT_BUFFER_SIZE) if output else sys.stdout
+        try:
+            out.write(','.join(['date'] + hosts) + '\n')
+            for date, host_data in _iter_spilled_rows(spill):
+                row = [date] + [host_data.get(host, '') for host in hosts]
+                out.write(','.join(row) + '\n')
+        finally:
+            if output:
+                out.close()
 
-        start_date += timedelta(days=1)
 
-    hosts = sorted(list(hosts))
-    print(','.join(['date'] + hosts))
-    for date, host_data in by_date.items():
-        row = [date] + [host_data[host] for host in hosts]
-        print(','.join(row))
+def _iter_spilled_rows(spill):
+    """Read back ``(date, host_data)`` rows from the spill file. Windows share their
+    boundaries so the same date may be spilled twice in a row, merge those."""
+    current_date, current = None, {}
+    for line in spill:
+        date, host_data = json.loads(line)
+        if date != current_date:
+            if current_date is not None:
+                yield current_date, current
+            current_date, current = date, {}
+        current.update(host_data)
+    if current_date is not None:
+        yield current_date, current
 
 
 def _get_args():
@@ -40,11 +73,12 @@ def _get_args():
     parser.add_argument(
         'query',
         help='Datadog query string. e.g. "max:system.mem.used{environment:icds}by{host}.rollup(max, 3600)',
-        required=True
     )
     parser.add_argument('--config', default='config.yml', help='Path to config file.')
     parser.add_argument('--start-date', type=arg_date_type, help='Start Date', required=True)
     parser.add_argument('--end-date', type=arg_date_type, help='End Date', required=True)
+    parser.add_argument('-o', '--output', help='Write the CSV to this file instead of stdout.')
+    add_query_args(parser)
     return parser.parse_args()
 
 
@@ -52,4 +86,5 @@ if __name__ == "__main__":
     args = _get_args()
     config = get_config(args.config)
     init_datadog(config)
-    export_metric(args.query, args.start_date, args.end_date)
\ No newline at end of file
+    configure_queries(args)
+    export_metric(args.query, args.start_date, args.end_date, args.output)
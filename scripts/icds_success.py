@@ -5,17 +5,24 @@
 from __future__ import absolute_import
 
 import argparse
-from datetime import datetime, timedelta
-from itertools import izip_longest
+from datetime import datetime
+try:
+    from itertools import izip_longest
+except ImportError:
+    from itertools import zip_longest as izip_longest
 
+import numpy as np
 import pytz
-from datadog import api
 from dateutil.relativedelta import relativedelta
 
 from const import ENV_TZ
+from series import Series
 from utils import get_date, get_config, init_datadog, adjust_datetime_to_utc
+from utils import add_query_args, configure_queries, query_batch, query_range, day_windows, window_edges
 
 INTERVAL_SEC = 15 * 60
+HOUR_SEC = 60 * 60
+DAY_SEC = 24 * 60 * 60
 
 MAX_INTERVAL_METRICS = {
     'Form Processing Volume': "sum:commcare.xform_submissions.count{{environment:{env},!submission_type:device-log}}.as_count().rollup(sum, {rollup})",
@@ -23,9 +30,16 @@ MAX_INTERVAL_METRICS = {
 }
 
 
+class Derived(object):
+    """A metric computed from the 15 minute series of one of the ``MAX_INTERVAL_METRICS``
+    rolled up to ``interval`` seconds rather than queried separately"""
+    def __init__(self, metric, interval):
+        self.metric = metric
+        self.interval = interval
+
+
 def _get_max(results):
-    pointslist = results['series'][0]['pointlist']
-    return sorted(pointslist, key=lambda p: p[1])[-1]
+    return Series.from_pointlist(results['series'][0]['pointlist']).argmax()
 
 
 def _get_avg(results):
@@ -45,13 +59,13 @@ METRICS = {
         []
     ),
     'Max Form submissions per day': (
-        "sum:commcare.xform_submissions.count{{environment:{env},!submission_type:device-log}}.as_count().rollup(sum, 86400)",
-        _get_max,
+        Derived('Form Processing Volume', DAY_SEC),
+        None,
         []
     ),
     'Max Restores submissions per day': (
-        "sum:commcare.restores.count{{environment:{env}}}.as_count().rollup(sum, 86400)",
-        _get_max,
+        Derived('Phone Sync Volume', DAY_SEC),
+        None,
         []
     ),
     'Avg {name} Success %': (
@@ -80,6 +94,7 @@ def _get_args():
     parser.add_argument('--end-date', help='End Date. Defaults to last day of last month')
     parser.add_argument('--show-data', action='store_true', help='Show all data.')
 
+    add_query_args(parser)
     return parser.parse_args()
 
 
@@ -90,76 +105,83 @@ def print_requests(normalize, start_date, end_date, show_data=False):
     end_utc = adjust_datetime_to_utc(end_date, timezone)
     print('Reporting for period: {} to {}'.format(start_utc, end_utc))
 
+    days = day_windows(start_utc, end_utc)
+    if not days:
+        print('Nothing to report, the end date is not after the start date')
+        return
+    day_edges = window_edges(days)
+    # one 15 minute fetch per metric, the hourly and daily peaks are rolled up from it
+    interval_series = {}
+    for metric, query in MAX_INTERVAL_METRICS.items():
+        query = query.format(env='icds', rollup=INTERVAL_SEC)
+        series = query_range(query, start_utc, days[-1][1], rollup=INTERVAL_SEC)['series']
+        interval_series[metric] = Series.from_pointlist(series[0]['pointlist'] if series else [])
+
+    outputs = []
     for metric, (query, extractor, contexts) in METRICS.items():
         contexts = contexts or [{}]
         for context in contexts:
             context['env'] = 'icds'
-            results = api.Metric.query(start=start_utc.strftime('%s'), end=end_utc.strftime('%s'), query=query.format(**context))
-            date, value = extractor(results)
-            date_output = ' on {}'.format(format_epoch(date, timezone)) if date else ''
-            print('\n{}: {:.0f}{}'.format(metric.format(**context), value, date_output))
-            print('{} (normalized to 100 users): {:.2f}{}'.format(metric.format(**context), normalize(value), date_output))
-
-    for metric in MAX_INTERVAL_METRICS:
+            outputs.append((metric, query if isinstance(query, Derived) else query.format(**context), extractor, context))
+
+    queries = [query for _, query, _, _ in outputs if not isinstance(query, Derived)]
+    all_results = iter(query_batch(queries, start_utc, end_utc))
+    for metric, query, extractor, context in outputs:
+        if isinstance(query, Derived):
+            # datadog aligns daily rollups to UTC midnight
+            peak = interval_series[query.metric].resample(query.interval * 1000).argmax()
+        else:
+            peak = extractor(next(all_results))
+        if peak is None:
+            print('\n{}: no data'.format(metric.format(**context)))
+            continue
+        date, value = peak
+        date_output = ' on {}'.format(format_epoch(date, timezone)) if date else ''
+        print('\n{}: {:.0f}{}'.format(metric.format(**context), value, date_output))
+        print('{} (normalized to 100 users): {:.2f}{}'.format(metric.format(**context), normalize(value), date_output))
+
+    for metric, series in interval_series.items():
         if show_data:
             print('\n{}'.format(metric))
             print('{}\n'.format('=' * len(metric)))
 
-        query = MAX_INTERVAL_METRICS[metric]
-        query = query.format(env='icds', rollup=INTERVAL_SEC)
-
-        daily_data = []
-        start_day = start_utc
-        while start_day < end_utc:
-            end_day = start_day + timedelta(days=1)
-
-            results = api.Metric.query(start=start_day.strftime('%s'), end=end_day.strftime('%s'), query=query)
-            series = results['series']
-            if not series:
-                start_day += timedelta(days=1)
-                continue
-
-            daily_data.append([
-                (point[0], int(point[1]) if point[1] is not None else 0)
-                for point in series[0]['pointlist']
-            ])
-
-            interval_start = daily_data[-1][0][0]
-            interval_end = daily_data[-1][1][0]
-            interval = interval_end - interval_start
-            if interval != INTERVAL_SEC * 1000:
-                print('[WARNING] data interval different from requested: {}'.format(interval / 1000))
-
-            start_day += timedelta(days=1)
-
+        by_day = series.split(day_edges)
         if show_data:
+            daily_data = [by_day[day] for day in by_day if len(by_day[day])]
             heads = ['#'] + [
-                '{}'.format(format_epoch(day_points[0][0], timezone)) for day_points in daily_data
+                '{}'.format(format_epoch(day_points.timestamps[0], timezone)) for day_points in daily_data
             ]
             print(','.join(heads))
-            for row_count, row in enumerate(izip_longest(*daily_data)):
+            for row_count, row in enumerate(izip_longest(*[np.nan_to_num(day.values) for day in daily_data])):
                 print(','.join([str(row_count)] + [
-                    str(pair[1]) if pair else ''
-                    for pair in row
+                    str(int(value)) if value is not None else ''
+                    for value in row
                 ]))
 
-        daily_max = []
-        for day in daily_data:
-            max_item = sorted(day, key=lambda x: x[1])[-1]
-            daily_max.append(max_item)
-
-        if show_data:
             print('\nDaily Max:')
-            for day, val_max in daily_max:
-                print('   {}: {}'.format(
+            for day, val_max in _get_daily_max(by_day):
+                print('   {}: {:.0f}'.format(
                     format_epoch(day, timezone, '%Y-%m-%d %H:%M'),
                     val_max
                 ))
 
-        max_item = sorted(daily_max, key=lambda x: x[1])[-1]
-        date = format_epoch(max_item[0], timezone, '%Y-%m-%d %H:%M')
-        print('\nPeak Performance (15 Minute Max) {}: {} on {}'.format(metric, max_item[1], date))
-        print('Peak Performance (15 Minute Max) {} normalized per 100 users: {:.1f} on {}'.format(metric, normalize(max_item[1]), date))
+        # local hours, IST is offset from UTC by half an hour
+        peaks = [
+            ('15 Minute', series.argmax()),
+            ('1 Hour', series.resample(HOUR_SEC * 1000, origin=day_edges[0]).argmax()),
+        ]
+        for label, peak in peaks:
+            if peak is None:
+                print('\nPeak Performance ({} Max) {}: no data'.format(label, metric))
+                continue
+            date = format_epoch(peak[0], timezone, '%Y-%m-%d %H:%M')
+            print('\nPeak Performance ({} Max) {}: {:.0f} on {}'.format(label, metric, peak[1], date))
+            print('Peak Performance ({} Max) {} normalized per 100 users: {:.1f} on {}'.format(label, metric, normalize(peak[1]), date))
+
+
+def _get_daily_max(by_day):
+    """(timestamp, value) of the peak of each day in a store from ``Series.split``"""
+    return [peak for peak in by_day.argmax().values() if peak is not None]
 
 
 def format_epoch(day, timezone, format='%Y-%m-%d'):
@@ -189,6 +211,7 @@ if __name__ == "__main__":
 
     config = get_config(args.config)
     init_datadog(config)
+    configure_queries(args)
 
     def normalize(value):
         # per 100 users
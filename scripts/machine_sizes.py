@@ -1,24 +1,45 @@
 from __future__ import print_function
 from __future__ import division
 import argparse
+import functools
 import json
+import os
 from collections import defaultdict, namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from memoized import memoized
 import time
 import sys
 
-from scripts.const import DATADOG_ENVS
-from utils import get_config, init_datadog, get_pointlist_by_host
+from const import DATADOG_ENVS
+from utils import get_config, init_datadog, get_pointlist_by_host, iter_json_items
+from utils import add_query_args, api_call, configure_queries, query_batch
+
+DEFAULT_INVENTORY_TTL_HOURS = 6
+OVERVIEW_CHUNK_SIZE = 64 * 1024
+
+_inventory_dir = None
+_inventory_ttl = DEFAULT_INVENTORY_TTL_HOURS * 3600
 
 
 def _get_args():
     parser = argparse.ArgumentParser(description='Print machine sizes for cluster.')
-    parser.add_argument('--env-name', choices=DATADOG_ENVS, help='Environment to query.', required=True)
+    parser.add_argument(
+        '--env-name', nargs='+', choices=DATADOG_ENVS + ['all'], required=True,
+        help='Environments to query, "all" for every environment. With more than one the output is a single fleet CSV.'
+    )
     parser.add_argument('-c', '--config', default='config.yml', help='Path to config file.', required=True)
     parser.add_argument('-d', '--days-past', type=int, help='How many days in the past to query.')
     parser.add_argument('--fixed-date', type=lambda d: datetime.strptime(d, '%Y-%m-%d') , help='Particular Date for which to query <YYYY-MM-DD>')
-
+    parser.add_argument(
+        '--inventory-ttl', type=float, default=DEFAULT_INVENTORY_TTL_HOURS,
+        help='How many hours to reuse the host inventory snapshot for before downloading it again.'
+    )
+    parser.add_argument(
+        '--inventory-diff', action='store_true',
+        help='Print the hosts that changed between the last two inventory snapshots instead of the CSV.'
+    )
+
+    add_query_args(parser)
     return parser.parse_args()
 
 
@@ -54,8 +75,18 @@ class Disk(object):
         return self.gb_size
 
 
-@memoized
-def get_host_stats(env_name):
+def configure_inventory(args):
+    global _inventory_dir, _inventory_ttl
+    # never mix generated or replayed hosts into the real snapshots, and leave them alone with --no-cache
+    if args.synthetic or args.replay or args.no_cache:
+        _inventory_dir = None
+    else:
+        _inventory_dir = os.path.join(args.cache_dir, 'inventory')
+    _inventory_ttl = 0 if args.refresh else args.inventory_ttl * 3600
+
+
+def _iter_overview_hosts(env_name):
+    """Stream the infrastructure overview, yielding the specs of each host as its row is parsed"""
     from datadog import api
     import requests
     s = requests.session()
@@ -67,31 +98,78 @@ def get_host_stats(env_name):
         'with_meta': True,
     }
     infra_link = 'https://app.datadoghq.com/reports/v2/overview'
-    infra_content = s.request(
-        method='GET', url=infra_link, params=s.params
-    ).json()
-    host_stats_list = []
-    all_disks = set()
-    for host in infra_content['rows']:
+    response = api_call(
+        s.request, method='GET', url=infra_link, params=s.params, stream=True
+    )
+    for host in iter_json_items(response.iter_content(OVERVIEW_CHUNK_SIZE), 'rows'):
         specs = json.loads(host['meta']['gohai'])
-        memory = kb_to_gb(specs['memory']['total'])
-        swap = kb_to_gb(specs['memory']['swap_total'])
-        cpu_logical_processors = int(specs['cpu']['cpu_logical_processors'])
-        disk = kb_to_gb('{}kB'.format(sum(int(drive['kb_size'])
-                                          for drive in specs['filesystem']
-                                          if drive['name'].startswith('/opt/data'))))
-        disks = {
-            drive['mounted_on']: Disk(drive['name'], drive['mounted_on'], int(drive['kb_size']))
-            for drive in specs['filesystem']
-            if drive['name'] not in disk_ignores and drive['mounted_on'] not in disk_ignores
+        yield {
+            'name': host['host_name'],
+            'memory': kb_to_gb(specs['memory']['total']),
+            'swap': kb_to_gb(specs['memory']['swap_total']),
+            'cpu_logical_processors': int(specs['cpu']['cpu_logical_processors']),
+            'disk': kb_to_gb('{}kB'.format(sum(int(drive['kb_size'])
+                                               for drive in specs['filesystem']
+                                               if drive['name'].startswith('/opt/data')))),
+            'all_disks': {
+                drive['mounted_on']: [drive['name'], drive['mounted_on'], int(drive['kb_size'])]
+                for drive in specs['filesystem']
+                if drive['name'] not in disk_ignores and drive['mounted_on'] not in disk_ignores
+            },
         }
+
+
+def _get_inventory_path(env_name, previous=False):
+    return os.path.join(_inventory_dir, '{}{}.json'.format(env_name, '.previous' if previous else ''))
+
+
+def _load_inventory(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_inventory(env_name, hosts):
+    """Save a new snapshot, keeping the last one to diff against"""
+    if not os.path.isdir(_inventory_dir):
+        os.makedirs(_inventory_dir)
+    path = _get_inventory_path(env_name)
+    if os.path.exists(path):
+        os.rename(path, _get_inventory_path(env_name, previous=True))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'fetched_at': time.time(), 'hosts': hosts}, f)
+    os.rename(tmp_path, path)
+
+
+def get_inventory(env_name):
+    """The specs of each host in the environment. Uses the snapshot from an
+    earlier run if it is within the TTL, otherwise downloads a new one."""
+    if _inventory_dir:
+        snapshot = _load_inventory(_get_inventory_path(env_name))
+        if snapshot and time.time() - snapshot['fetched_at'] < _inventory_ttl:
+            return snapshot['hosts']
+
+    hosts = list(_iter_overview_hosts(env_name))
+    if _inventory_dir:
+        _save_inventory(env_name, hosts)
+    return hosts
+
+
+@functools.lru_cache(maxsize=None)
+def get_host_stats(env_name):
+    host_stats_list = []
+    all_disks = set()
+    for host in get_inventory(env_name):
+        disks = {mount_point: Disk(*disk) for mount_point, disk in host['all_disks'].items()}
         all_disks.update(set(disks))
         host_stats_list.append(HostStats(
-            name=host['host_name'],
-            memory=memory,
-            swap=swap,
-            cpu_logical_processors=cpu_logical_processors,
-            disk=disk,
+            name=host['name'],
+            memory=host['memory'],
+            swap=host['swap'],
+            cpu_logical_processors=host['cpu_logical_processors'],
+            disk=host['disk'],
             all_disks=disks,
             cpu_max_usage=None,
             memory_max_usage=None
@@ -100,8 +178,56 @@ def get_host_stats(env_name):
     return host_stats_list, all_disks
 
 
+def diff_inventory(old_hosts, new_hosts):
+    """Compare two snapshots. Returns the names of the hosts that were added and
+    removed and a dict of the changed hosts to a list of ``(field, old, new)``."""
+    old_by_name = {host['name']: host for host in old_hosts}
+    new_by_name = {host['name']: host for host in new_hosts}
+    added = sorted(set(new_by_name) - set(old_by_name))
+    removed = sorted(set(old_by_name) - set(new_by_name))
+    changed = {}
+    for name in sorted(set(old_by_name) & set(new_by_name)):
+        old, new = old_by_name[name], new_by_name[name]
+        changes = [
+            (field, old[field], new[field])
+            for field in ('memory', 'swap', 'cpu_logical_processors', 'disk')
+            if old[field] != new[field]
+        ]
+        for mount_point in sorted(set(old['all_disks']) | set(new['all_disks'])):
+            old_disk, new_disk = old['all_disks'].get(mount_point), new['all_disks'].get(mount_point)
+            if old_disk != new_disk:
+                changes.append((
+                    mount_point,
+                    Disk(*old_disk).gb_size if old_disk else None,
+                    Disk(*new_disk).gb_size if new_disk else None,
+                ))
+        if changes:
+            changed[name] = changes
+    return added, removed, changed
+
+
+def print_inventory_diff(env_names):
+    for env_name in env_names:
+        get_inventory(env_name)  # refresh the snapshot if it has expired
+        previous = _load_inventory(_get_inventory_path(env_name, previous=True))
+        if not previous:
+            print('{}: no earlier snapshot to compare with'.format(env_name))
+            continue
+        current = _load_inventory(_get_inventory_path(env_name))
+        added, removed, changed = diff_inventory(previous['hosts'], current['hosts'])
+        print('{}: {} added, {} removed, {} changed since {}'.format(
+            env_name, len(added), len(removed), len(changed),
+            datetime.utcfromtimestamp(previous['fetched_at']).strftime('%Y-%m-%d %H:%M UTC')
+        ))
+        for name in added:
+            print('  + {}'.format(name))
+        for name in removed:
+            print('  - {}'.format(name))
+        for name, changes in sorted(changed.items()):
+            print('  ~ {}: {}'.format(name, ', '.join('{} {} -> {}'.format(*change) for change in changes)))
+
+
 def get_host_usage_stats(env_name, days_past, fixed_date):
-    from datadog import api
  
     def datetime_timestamp(days_past, fixed_date):
         if days_past:
@@ -116,20 +242,17 @@ def get_host_usage_stats(env_name, days_past, fixed_date):
     start_time,end_time = datetime_timestamp(days_past, fixed_date)
 
     usage_stats_by_host = defaultdict(dict)
-    host_stats, all_disks = get_host_stats(env_name)
-    host_stats_by_host = {stats.name: stats for stats in host_stats}
-    
-    
-      
-    def add_highest_cpu_in_last_week():
+
+    def add_highest_cpu_in_last_week(result):
         """
         CPU expressed as proportion of total used. E.g. 0.25 means 25% used
         """
-        query = 'min:system.cpu.idle{environment:%s}by{host}.rollup(min, 86400)' % env_name
-        cpu_stats = get_pointlist_by_host(api.Metric.query(start=start_time, end=end_time, query=query))
-        for host, pointlist in cpu_stats.items():
+        cpu_stats = get_pointlist_by_host(result, as_store=True)
+        for (host,), min_idle in cpu_stats.min().items():
+            if min_idle is None:  # no data for the host
+                continue
             try:
-                cpu_proportion = (1 - min(value for _, value in pointlist if value is not None) / 100)
+                cpu_proportion = (1 - min_idle / 100)
                 cpu_total = host_stats_by_host[host].cpu_logical_processors
                 usage_stats_by_host[host]['cpu_logical_processors'] = cpu_total * cpu_proportion
                 usage_stats_by_host[host]['cpu_max_usage'] = cpu_proportion * 100
@@ -137,97 +260,134 @@ def get_host_usage_stats(env_name, days_past, fixed_date):
                 usage_stats_by_host[host]['cpu_logical_processors'] = 'NA'
                 usage_stats_by_host[host]['cpu_max_usage'] = 'NA'
 
-    def add_highest_mem_in_last_week():
-        query = 'max:system.mem.used{environment:%s}by{host}.rollup(max, 86400)' % env_name
-        mem_stats = get_pointlist_by_host(api.Metric.query(start=start_time, end=end_time, query=query))
-        for host, pointlist in mem_stats.items():
+    def add_highest_mem_in_last_week(result):
+        mem_stats = get_pointlist_by_host(result, as_store=True)
+        for (host,), max_used in mem_stats.max().items():
+            if max_used is None:
+                continue
             try:
                 memory_total = host_stats_by_host[host].memory
-                max_usage = max(value for _, value in pointlist) / 1024 ** 3
+                max_usage = max_used / 1024 ** 3
                 usage_stats_by_host[host]['memory'] = max_usage
                 usage_stats_by_host[host]['memory_max_usage'] = 100 * max_usage / int(memory_total)
             except KeyError:
                 usage_stats_by_host[host]['memory'] = 'NA'
                 usage_stats_by_host[host]['memory_max_usage'] = 'NA'
 
-    def add_highest_swap_in_last_week():
-        query = 'max:system.swap.used{environment:%s}by{host}.rollup(max, 86400)' % env_name
-        swap_stats = get_pointlist_by_host(api.Metric.query(start=start_time, end=end_time, query=query))
-        for host, pointlist in swap_stats.items():
+    def add_highest_swap_in_last_week(result):
+        swap_stats = get_pointlist_by_host(result, as_store=True)
+        for (host,), max_used in swap_stats.max().items():
+            if max_used is None:
+                continue
             try:
-                usage_stats_by_host[host]['swap'] = max(value for _, value in pointlist) / 1024 ** 3
+                usage_stats_by_host[host]['swap'] = max_used / 1024 ** 3
             except KeyError:
                 usage_stats_by_host[host]['swap'] = 'NA'
 
-    def add_highest_disk_in_last_week():
+    def add_highest_disk_in_last_week(result):
         for host in host_stats_by_host:
                 usage_stats_by_host[host]['disk'] = 0
                 usage_stats_by_host[host]['all_disks'] = defaultdict(int)
 
-        query = 'max:system.disk.in_use{environment:%s}by{host,device}.rollup(max, 86400)' % (env_name)
-        disk_stats = get_pointlist_by_host(api.Metric.query(start=start_time, end=end_time, query=query), tags=['host', 'device'])
-        for host, by_device in disk_stats.items():
-            for device, pointlist in by_device.items():
-                try:
-                    new_value = max(value for _, value in pointlist) * 100
-                    if device in ('/opt/data', '/opt/data/ecrusage_stats_by_hostusage_stats_by_hostypt', '/opt_new', '/opt/data1'):
-                        usage_stats_by_host[host]['disk'] = max(usage_stats_by_host[host]['disk'], new_value)  
-
-                    if not (usage_stats_by_host[host]['disk'] == 'NA'):
-                        usage_stats_by_host[host]['all_disks'][device] = max(usage_stats_by_host[host]['all_disks'][device], new_value)
-                except KeyError:
-                    usage_stats_by_host[host]['disk'] = 'NA'
-                    usage_stats_by_host[host]['all_disks'] = 'NA'
-
-    add_highest_cpu_in_last_week()
-    add_highest_mem_in_last_week()
-    add_highest_swap_in_last_week()
-    add_highest_disk_in_last_week()
+        disk_stats = get_pointlist_by_host(result, tags=['host', 'device'], as_store=True)
+        for (host, device), max_in_use in disk_stats.max().items():
+            if max_in_use is None:
+                continue
+            try:
+                new_value = max_in_use * 100
+                if device in ('/opt/data', '/opt/data/ecrusage_stats_by_hostusage_stats_by_hostypt', '/opt_new', '/opt/data1'):
+                    usage_stats_by_host[host]['disk'] = max(usage_stats_by_host[host]['disk'], new_value)  
+
+                if not (usage_stats_by_host[host]['disk'] == 'NA'):
+                    usage_stats_by_host[host]['all_disks'][device] = max(usage_stats_by_host[host]['all_disks'][device], new_value)
+            except KeyError:
+                usage_stats_by_host[host]['disk'] = 'NA'
+                usage_stats_by_host[host]['all_disks'] = 'NA'
+
+    # fetch the infrastructure overview while the usage queries run
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        host_stats_future = executor.submit(get_host_stats, env_name)
+        cpu_result, mem_result, swap_result, disk_result = query_batch([
+            'min:system.cpu.idle{environment:%s}by{host}.rollup(min, 86400)' % env_name,
+            'max:system.mem.used{environment:%s}by{host}.rollup(max, 86400)' % env_name,
+            'max:system.swap.used{environment:%s}by{host}.rollup(max, 86400)' % env_name,
+            'max:system.disk.in_use{environment:%s}by{host,device}.rollup(max, 86400)' % env_name,
+        ], start_time, end_time)
+        host_stats, all_disks = host_stats_future.result()
+    host_stats_by_host = {stats.name: stats for stats in host_stats}
+
+    add_highest_cpu_in_last_week(cpu_result)
+    add_highest_mem_in_last_week(mem_result)
+    add_highest_swap_in_last_week(swap_result)
+    add_highest_disk_in_last_week(disk_result)
     
     # DELETE HOSTS FROM DICT
-    for key,value in usage_stats_by_host.items():
+    for key,value in list(usage_stats_by_host.items()):
         if 'NA' in value: # WHICH DATA ARE AVAILABLE IN PAST BUT REMOVED NOW
             del usage_stats_by_host[key]
-        if len(usage_stats_by_host[key]) < 7: # WHICH DATA ARE PRESENT NOW BUT NOT AVAILABLE IN PAST
+        elif len(usage_stats_by_host[key]) < 7: # WHICH DATA ARE PRESENT NOW BUT NOT AVAILABLE IN PAST
             del usage_stats_by_host[key]     
                
     return sorted((HostStats(name=host, **stats)  for host, stats in usage_stats_by_host.items()),
                   key=lambda host_stats: host_stats.name)
 
 
-def print_hosts(env_name):
-    stats, all_disks = get_host_stats(env_name)
-    all_disks = sorted(all_disks)
-    print('{},{},{},{},{}'.format('Name', 'Memory (GB)', 'Swap (GB)', 'Logical Processors', ','.join(all_disks)))
+def get_fleet_usage_stats(env_names, days_past, fixed_date):
+    """Get the usage stats of each environment, querying them all concurrently"""
+    with ThreadPoolExecutor(max_workers=len(env_names)) as executor:
+        futures = [executor.submit(get_host_usage_stats, env_name, days_past, fixed_date) for env_name in env_names]
+        return OrderedDict((env_name, future.result()) for env_name, future in zip(env_names, futures))
+
+
+def _get_all_disks(env_names):
+    if len(env_names) == 1:
+        return get_host_stats(env_names[0])[1]
+    return set().union(*(get_host_stats(env_name)[1] for env_name in env_names))
+
+
+def _print_row(env_names, env_name, row):
+    """Rows of the combined fleet CSV start with the environment"""
+    print('{},{}'.format(env_name, row) if len(env_names) > 1 else row)
+
+
+def print_hosts(env_names):
+    all_disks = sorted(_get_all_disks(env_names))
+    _print_row(env_names, 'Environment', '{},{},{},{},{}'.format(
+        'Name', 'Memory (GB)', 'Swap (GB)', 'Logical Processors', ','.join(all_disks)
+    ))
     template = '{name},{memory},{swap},{cpu_logical_processors},{%s}' % '},{'.join(all_disks)
-    for host_stats in stats:
-        asdict = host_stats._asdict()
-        disks = asdict.pop('all_disks')
-        disks = OrderedDict(sorted(disks.items()))
-        for d in all_disks:
-            disks.setdefault(d, '')
-        asdict.update(disks)
-        print(template.format(**asdict))
-
-
-def print_host_usage(env_name, days_past, date_fixed):
-    stats, all_disks = get_host_stats(env_name)
+    for env_name in env_names:
+        stats, _ = get_host_stats(env_name)
+        for host_stats in stats:
+            asdict = host_stats._asdict()
+            disks = asdict.pop('all_disks')
+            disks = OrderedDict(sorted(disks.items()))
+            for d in all_disks:
+                disks.setdefault(d, '')
+            asdict.update(disks)
+            _print_row(env_names, env_name, template.format(**asdict))
+
+
+def print_host_usage(usage_stats_by_env):
+    env_names = list(usage_stats_by_env)
+    all_disks = _get_all_disks(env_names)
     fixed_headers = ','.join([
         'Name', 'Memory (GB)', 'Swap (GB)', 'Logical Processors',
         'Max Memory Usage (%)', 'Max CPU Usage (%)', 'Max Disk Usage (%)'
     ])
-    print('{},{}'.format(fixed_headers, ','.join(all_disks)))
+    _print_row(env_names, 'Environment', '{},{}'.format(fixed_headers, ','.join(all_disks)))
     template = '{name},{memory:.1f},{swap:.1f},{cpu_logical_processors:.1f},{memory_max_usage:.1f},{cpu_max_usage:.1f},{disk_max:.1f},{%s:.1f}' % ':.1f},{'.join(all_disks)
-    for host_stats in get_host_usage_stats(env_name, days_past, date_fixed):
-        asdict = host_stats._asdict()
-        disks = asdict.pop('all_disks')
-        if disks != 'NA':
-            disks = OrderedDict(sorted(disks.items()))
-            for d in all_disks:
-                disks.setdefault(d, 0)
-            asdict.update(disks)
-            asdict['disk_max'] = max(disks.values())
-            print(template.format(**asdict))
+    for env_name, usage_stats in usage_stats_by_env.items():
+        for host_stats in usage_stats:
+            asdict = host_stats._asdict()
+            disks = asdict.pop('all_disks')
+            if disks != 'NA':
+                disks = OrderedDict(sorted(disks.items()))
+                for d in all_disks:
+                    disks.setdefault(d, 0)
+                asdict.update(disks)
+                asdict['disk_max'] = max(disks.values())
+                _print_row(env_names, env_name, template.format(**asdict))
 
 
 if __name__ == "__main__":
@@ -240,5 +400,15 @@ if __name__ == "__main__":
         sys.exit(1)
     config = get_config(args.config)
     init_datadog(config)
-    print_hosts(args.env_name)
-    print_host_usage(args.env_name, args.days_past, args.fixed_date)
+    configure_queries(args)
+    configure_inventory(args)
+    env_names = DATADOG_ENVS if 'all' in args.env_name else list(OrderedDict.fromkeys(args.env_name))
+    if args.inventory_diff:
+        if not _inventory_dir:
+            print("ERROR : Inventory snapshots aren't used with --no-cache, when replaying or with synthetic data")
+            sys.exit(1)
+        print_inventory_diff(env_names)
+        sys.exit(0)
+    usage_stats_by_env = get_fleet_usage_stats(env_names, args.days_past, args.fixed_date)
+    print_hosts(env_names)
+    print_host_usage(usage_stats_by_env)
@@ -1,19 +1,39 @@
 import argparse
+import bisect
 import csv
+import json
 import os
 import re
-import sys
+from collections import defaultdict
 
-from datadog import api
+from mirror import Mirror, add_mirror_args, get_mirror
+from utils import add_replay_args, configure_replay, get_config, init_datadog
 
-from utils import get_config, init_datadog
+
+# a metric or a tag group e.g. 'sum:commcare.restores.count{environment:icds,!host:web0}' or 'by {host}'
+SCOPE_RE = re.compile(r'(\w[\w.\-]*)\s*\{([^}]*)\}')
+# patterns made of these are looked up in the index rather than run as regexes
+PLAIN_PATTERN_RE = re.compile(r'^[\w.:/$-]+\*?$')
+
+INDEX_FILENAME = 'query_index.json'
+# bump when the way queries are tokenized changes so old indexes are rebuilt
+INDEX_VERSION = 2
 
 
 def _get_args():
     parser = argparse.ArgumentParser(description='Location all usages of metric')
-    parser.add_argument('metrics', nargs='+', help='Metric to search for, can supply multiple')
+    parser.add_argument(
+        'metrics', nargs='*',
+        help='Metric to search for, can supply multiple. Metric names and tags (e.g. "host" or "environment:icds") '
+             'are matched exactly, end with "*" to match a prefix. Anything else is treated as a regex.'
+    )
+    parser.add_argument('--list-metrics', action='store_true', help='List all metrics used with their usage count')
+    parser.add_argument(
+        '--cache', help='Search the queries saved in this CSV file if it exists, otherwise save them to it.'
+    )
     parser.add_argument('--config', default='config.yml', help='Path to config file.')
-    parser.add_argument('--cache', help='Use this file to cache results')
+    add_mirror_args(parser)
+    add_replay_args(parser)
     return parser.parse_args()
 
 
@@ -21,101 +41,199 @@ def _get_query(request):
     return request.get('q', request.get('query'))
 
 
-def _check_query(metrics, query, location):
-    for metric in metrics:
-        if metric.findall(query):
-            print("{}\n\tquery = '{}'\n".format(location, query))
-
-
-class CacheBase:
-    mode = None
-    def __init__(self, path):
-        self.path = path
-        self.file = None
-
-    def __enter__(self):
-        if self.path:
-            self.file = open(self.path, self.mode)
-        return self
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.file.close()
-
-
-class CacheWriter(CacheBase):
-    mode = "w"
-    def __enter__(self):
-        super().__enter__()
-        if self.file:
-            self.writer = csv.writer(self.file)
-        return self
-
-    def write(self, q, location):
-        if self.file:
-            self.writer.writerow([q, location])
-
-
-class CacheReader(CacheBase):
-    mode = "r"
-
-    def __enter__(self):
-        super().__enter__()
-        if self.file:
-            self.reader = csv.reader(self.file)
-        return self
-
-    def read(self):
-        return self.reader
+def _iter_dashboard_queries(dashboard):
+    for widget in dashboard['widgets']:
+        widget = widget['definition']
+        location = "Dashboard: '{}', Widget: '{}'".format(dashboard['title'], widget.get('title', ''))
+        requests = widget.get('requests')
+        if not requests:
+            continue
+        if isinstance(requests, list):
+            for req in requests:
+                if 'q' in req:
+                    yield _get_query(req), location
+        elif isinstance(requests, dict):
+            try:
+                yield _get_query(requests['fill']), location
+            except KeyError:
+                pass
+
+            try:
+                yield _get_query(requests['size']), location
+            except KeyError:
+                pass
+
+
+def _iter_monitor_queries(monitors):
+    for monitor in monitors:
+        location = "Monitor: {}".format(monitor['name'])
+        yield _get_query(monitor), location
+
+
+def _iter_item_queries(kind, item):
+    if kind == 'dashboards':
+        return _iter_dashboard_queries(item)
+    return _iter_monitor_queries([item])
+
+
+def _iter_queries(mirror):
+    """Yield ``(query, location)`` for every dashboard widget and monitor in the mirror"""
+    for dashboard in mirror.iter_dashboards():
+        for q, location in _iter_dashboard_queries(dashboard):
+            yield q, location
+    for q, location in _iter_monitor_queries(mirror.iter_monitors()):
+        yield q, location
+
+
+def _print_match(q, location):
+    print("{}\n\tquery = '{}'\n".format(location, q))
+
+
+def get_query_tokens(query):
+    """Split a query into the metric names and tags it uses. Tags are included
+    both as the key and as 'key:value' so either can be looked up e.g.
+    'sum:nginx.requests{environment:icds} by {url}' uses the metric 'nginx.requests'
+    and the tags 'environment', 'environment:icds' and 'url'.
+    """
+    metrics, tags = set(), set()
+    for name, scope in SCOPE_RE.findall(query or ''):
+        if name != 'by':
+            metrics.add(name)
+        for tag in scope.split(','):
+            tag = tag.strip().lstrip('!')
+            if not tag or tag == '*':
+                continue
+            tags.add(tag)
+            if ':' in tag:
+                tags.add(tag.split(':', 1)[0])
+    return metrics, tags
+
+
+def query_matches(pattern, query):
+    """Whether ``query`` matches ``pattern`` the way ``QueryIndex.search`` matches it"""
+    if PLAIN_PATTERN_RE.match(pattern):
+        metrics, tags = get_query_tokens(query)
+        if pattern.endswith('*'):
+            return any(token.startswith(pattern[:-1]) for token in metrics | tags)
+        return pattern in metrics or pattern in tags
+    return bool(query and re.search(pattern, query))
+
+
+class QueryIndex(object):
+    """Inverted index from the metric names and tags used in dashboards and
+    monitors to the queries that use them"""
+
+    def __init__(self, entries, metrics, tags):
+        self.entries = entries  # list of [query, location]
+        self.metrics = metrics  # metric name -> entry positions
+        self.tags = tags  # tag -> entry positions
+        self._sorted_tokens = sorted(set(metrics) | set(tags))
+
+    @classmethod
+    def build(cls, queries):
+        entries = []
+        metrics, tags = defaultdict(list), defaultdict(list)
+        for query, location in queries:
+            position = len(entries)
+            entries.append([query, location])
+            query_metrics, query_tags = get_query_tokens(query)
+            for metric in query_metrics:
+                metrics[metric].append(position)
+            for tag in query_tags:
+                tags[tag].append(position)
+        return cls(entries, dict(metrics), dict(tags))
+
+    @classmethod
+    def load(cls, path):
+        """Load a saved index, or return None if it was saved by another version"""
+        with open(path) as f:
+            data = json.load(f)
+        if data.get('version') != INDEX_VERSION:
+            return None
+        return cls(data['entries'], data['metrics'], data['tags'])
+
+    def save(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'version': INDEX_VERSION, 'entries': self.entries, 'metrics': self.metrics, 'tags': self.tags,
+            }, f)
+        os.rename(tmp_path, path)
+
+    def _get_positions(self, token):
+        return set(self.metrics.get(token, ())) | set(self.tags.get(token, ()))
+
+    def _iter_prefixed(self, prefix):
+        i = bisect.bisect_left(self._sorted_tokens, prefix)
+        while i < len(self._sorted_tokens) and self._sorted_tokens[i].startswith(prefix):
+            yield self._sorted_tokens[i]
+            i += 1
+
+    def search(self, pattern):
+        """Return the ``(query, location)`` entries matching ``pattern`` in the order they were indexed"""
+        if PLAIN_PATTERN_RE.match(pattern):
+            if pattern.endswith('*'):
+                positions = set()
+                for token in self._iter_prefixed(pattern[:-1]):
+                    positions |= self._get_positions(token)
+            else:
+                positions = self._get_positions(pattern)
+        else:
+            regex = re.compile(pattern)
+            positions = {i for i, (query, _) in enumerate(self.entries) if query and regex.search(query)}
+        return [self.entries[i] for i in sorted(positions)]
+
+    def get_metric_counts(self):
+        return {metric: len(positions) for metric, positions in self.metrics.items()}
+
+
+def get_index(mirror):
+    """Get the index of the mirror's queries, rebuilding it if the mirror has changed since it was built"""
+    path = os.path.join(mirror.path, INDEX_FILENAME)
+    if os.path.exists(path) and os.path.exists(mirror.index_path) and \
+            os.path.getmtime(path) >= os.path.getmtime(mirror.index_path):
+        index = QueryIndex.load(path)
+        if index:
+            return index
+    index = QueryIndex.build(_iter_queries(mirror))
+    index.save(path)
+    return index
 
 
 if __name__ == "__main__":
     args = _get_args()
     config = get_config(args.config)
     init_datadog(config)
+    configure_replay(args)
 
-    metrics = [re.compile(pattern) for pattern in args.metrics]
-
+    if not args.metrics and not args.list_metrics:
+        raise SystemExit('Supply at least one metric or --list-metrics')
 
+    patterns = args.metrics
     if args.cache and os.path.isfile(args.cache):
-        with CacheReader(args.cache) as cache:
-            for q, location in cache.read():
-                _check_query(metrics, q, location)
-        sys.exit()
-
-    with CacheWriter(args.cache) as cache:
-        dashboards = api.Dashboard.get_all()
-        for dashboard_info in dashboards['dashboards']:
-            dashboard = api.Dashboard.get(dashboard_info['id'])
-            for widget in dashboard['widgets']:
-                widget = widget['definition']
-                location = "Dashboard: '{}', Widget: '{}'".format(dashboard['title'], widget.get('title', ''))
-                requests = widget.get('requests')
-                if not requests:
-                    continue
-                if isinstance(requests, list):
-                    for req in requests:
-                        if 'q' in req:
-                            q = _get_query(req)
-                            cache.write(q, location)
-                            _check_query(metrics, q, location)
-                elif isinstance(requests, dict):
-                    try:
-                        q = _get_query(requests['fill'])
-                        cache.write(q, location)
-                        _check_query(metrics, q, location)
-                    except KeyError:
-                        pass
-
-                    try:
-                        q = _get_query(requests['size'])
-                        cache.write(q, location)
-                        _check_query(metrics, q, location)
-                    except KeyError:
-                        pass
-
-        monitors = api.Monitor.get_all()
-        for monitor in monitors:
-            location = "Monitor: {}".format(monitor['name'])
-            q = _get_query(monitor)
-            cache.write(q, location)
-            _check_query(metrics, q, location)
+        with open(args.cache) as f:
+            index = QueryIndex.build(csv.reader(f))
+    else:
+        streamed = not args.no_sync and Mirror(args.mirror_dir).is_cold()
+
+        def print_matches(kind, item):
+            for q, location in _iter_item_queries(kind, item):
+                if any(query_matches(pattern, q) for pattern in args.metrics):
+                    _print_match(q, location)
+
+        # nothing has been indexed yet so print the matches as the mirror is filled
+        mirror = get_mirror(args, on_fetched=print_matches if streamed else None)
+        index = get_index(mirror)
+        if args.cache:
+            with open(args.cache, 'w') as f:
+                csv.writer(f).writerows(index.entries)
+        if streamed:
+            patterns = []  # already printed
+
+    if args.list_metrics:
+        for metric, count in sorted(index.get_metric_counts().items()):
+            print('{}\t{}'.format(metric, count))
+
+    for pattern in patterns:
+        for q, location in index.search(pattern):
+            _print_match(q, location)
@@ -0,0 +1,135 @@
+# Local mirror of all dashboard and monitor definitions.
+#
+# Each dashboard and monitor is stored as a JSON file along with an index of
+# their modification times. Syncing only fetches the dashboards that are new
+# or have changed since the last sync and removes the ones that were deleted.
+from __future__ import print_function
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from datadog import api
+
+from utils import DEFAULT_CACHE_DIR, api_call
+
+DEFAULT_MIRROR_DIR = os.path.join(DEFAULT_CACHE_DIR, 'mirror')
+
+
+def add_mirror_args(parser):
+    parser.add_argument('--mirror-dir', default=DEFAULT_MIRROR_DIR, help='Directory for the dashboard and monitor mirror.')
+    parser.add_argument('--no-sync', action='store_true', help='Use the mirror as it is without syncing it first.')
+    parser.add_argument('--workers', type=int, default=8, help='Number of concurrent requests to datadog.')
+
+
+class Mirror(object):
+    def __init__(self, path):
+        self.path = path
+        self.index_path = os.path.join(path, 'index.json')
+        for kind in ('dashboards', 'monitors'):
+            if not os.path.isdir(os.path.join(path, kind)):
+                os.makedirs(os.path.join(path, kind))
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return {'dashboards': {}, 'monitors': {}}
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    def _get_path(self, kind, object_id):
+        return os.path.join(self.path, kind, '{}.json'.format(object_id))
+
+    def _write(self, path, data):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp_path, path)
+
+    def _remove_deleted(self, kind, index, current_ids):
+        deleted = set(index[kind]) - set(current_ids)
+        for object_id in deleted:
+            del index[kind][object_id]
+            if os.path.exists(self._get_path(kind, object_id)):
+                os.remove(self._get_path(kind, object_id))
+        return len(deleted)
+
+    def is_cold(self):
+        """Whether the mirror has never been synced"""
+        return not os.path.exists(self.index_path)
+
+    def sync(self, workers=8, on_fetched=None):
+        """Bring the mirror up to date. Returns a dict of counts of the dashboards
+        and monitors that were fetched, left unchanged and removed.
+        ``on_fetched(kind, item)`` is called with each dashboard and monitor as it is fetched."""
+        index = self._load_index()
+        stats = {'fetched': 0, 'unchanged': 0, 'deleted': 0}
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            monitors_future = executor.submit(api_call, api.Monitor.get_all)
+            listing = api_call(api.Dashboard.get_all)['dashboards']
+
+            futures = {}
+            for dashboard_info in listing:
+                dashboard_id = str(dashboard_info['id'])
+                modified = dashboard_info.get('modified_at')
+                if index['dashboards'].get(dashboard_id) == modified and os.path.exists(
+                        self._get_path('dashboards', dashboard_id)):
+                    stats['unchanged'] += 1
+                    continue
+                future = executor.submit(api_call, api.Dashboard.get, dashboard_info['id'])
+                futures[future] = (dashboard_id, modified)
+
+            for future in as_completed(futures):
+                dashboard_id, modified = futures[future]
+                dashboard = future.result()
+                if 'errors' in dashboard:
+                    raise Exception(dashboard['errors'])
+                self._write(self._get_path('dashboards', dashboard_id), dashboard)
+                index['dashboards'][dashboard_id] = modified
+                stats['fetched'] += 1
+                if on_fetched:
+                    on_fetched('dashboards', dashboard)
+            stats['deleted'] += self._remove_deleted(
+                'dashboards', index, [str(dashboard_info['id']) for dashboard_info in listing]
+            )
+
+            # the monitor listing already contains the full definitions
+            monitors = monitors_future.result()
+            for monitor in monitors:
+                monitor_id = str(monitor['id'])
+                if index['monitors'].get(monitor_id) == monitor.get('modified') and os.path.exists(
+                        self._get_path('monitors', monitor_id)):
+                    stats['unchanged'] += 1
+                    continue
+                self._write(self._get_path('monitors', monitor_id), monitor)
+                index['monitors'][monitor_id] = monitor.get('modified')
+                stats['fetched'] += 1
+                if on_fetched:
+                    on_fetched('monitors', monitor)
+            stats['deleted'] += self._remove_deleted('monitors', index, [str(monitor['id']) for monitor in monitors])
+
+        # the index modification time marks when the mirror last changed
+        if stats['fetched'] or stats['deleted'] or not os.path.exists(self.index_path):
+            self._write(self.index_path, index)
+        return stats
+
+    def _iter(self, kind):
+        index = self._load_index()
+        for object_id in sorted(index[kind]):
+            with open(self._get_path(kind, object_id)) as f:
+                yield json.load(f)
+
+    def iter_dashboards(self):
+        return self._iter('dashboards')
+
+    def iter_monitors(self):
+        return self._iter('monitors')
+
+
+def get_mirror(args, force_sync=False, on_fetched=None):
+    """Get the mirror, synced unless ``--no-sync`` was given and ``force_sync`` isn't set"""
+    mirror = Mirror(args.mirror_dir)
+    if force_sync or not args.no_sync:
+        stats = mirror.sync(args.workers, on_fetched)
+        print('Synced mirror: {fetched} fetched, {unchanged} unchanged, {deleted} deleted'.format(**stats))
+    return mirror
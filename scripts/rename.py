@@ -2,14 +2,29 @@ import argparse
 import difflib
 import itertools
 import json
+import os
 import re
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
 from datadog import api
 
-from utils import get_config, init_datadog
+from mirror import add_mirror_args, get_mirror
+from utils import add_replay_args, api_call, configure_replay, get_config, init_datadog
 from clint.textui import colored
 
+TOKEN_SPLIT_RE = re.compile('[:{}]')
+# metric names and tag values, runs of whitespace and single operators or punctuation
+DIFF_TOKEN_RE = re.compile(r'[\w.]+|\s+|[^\w\s]')
+
+DIFF_MODES = ('token', 'char')
+DIFF_MODE = 'token'
+
+
+def tokenize(query):
+    return TOKEN_SPLIT_RE.split(query)
+
 
 class IN(object):
     def __init__(self, val, tokenize=False):
@@ -19,7 +34,7 @@ class IN(object):
     def __call__(self, query):
         if not self.tokenize:
             return self.val in query
-        tokens = re.split('[:{}]', query)
+        tokens = tokenize(query)
         return any(token == self.val for token in tokens)
 
     def __repr__(self):
@@ -62,6 +77,7 @@ class NOT(object):
 class Rename(object):
     def __init__(self, from_val, to_val, *checkers):
         self.checker = AND(IN(from_val, tokenize=True), *checkers)
+        self.extra_checker = AND(*checkers)
         self.from_val = from_val
         self.to_val = to_val
         self.seen = False
@@ -70,6 +86,11 @@ class Rename(object):
         if self.checker(query):
             return query.replace(self.from_val, self.to_val)
 
+    def apply_to_candidate(self, query):
+        """Like calling the change but for a query already known to contain ``from_val`` as a token"""
+        if self.extra_checker(query):
+            return query.replace(self.from_val, self.to_val)
+
     def mark_seen(self):
         self.seen = True
 
@@ -80,6 +101,37 @@ class Rename(object):
         return "Change(from='{self.from_val}', to='{self.to_val}', checks={self.checker})".format(self=self)
 
 
+class RenameMatcher(object):
+    """All the changes compiled into one lookup from token to the changes renaming it,
+    so each query is only tokenized once rather than once per change"""
+
+    def __init__(self, changes):
+        self.changes = list(itertools.chain.from_iterable(changes))
+        self.changes_by_token = defaultdict(list)
+        for position, change in enumerate(self.changes):
+            self.changes_by_token[change.from_val].append(position)
+
+    def _get_candidates(self, query, after):
+        positions = set()
+        for token in set(tokenize(query)):
+            positions.update(self.changes_by_token.get(token, ()))
+        return sorted(position for position in positions if position > after)
+
+    def iter_changes(self, query):
+        """Apply the changes to ``query`` in order, yielding ``(change, new_query)``
+        for each one that matched"""
+        candidates = self._get_candidates(query, -1)
+        while candidates:
+            position = candidates.pop(0)
+            change = self.changes[position]
+            new = change.apply_to_candidate(query)
+            if new:
+                yield change, new
+                query = new
+                # the tokens have changed so later changes need to be looked up again
+                candidates = self._get_candidates(query, position)
+
+
 def histogram_change(orig_name, new_name, tag_name='duration'):
     return [
         Rename(orig_name, new_name, IN('by {{{}}}'.format(tag_name))),
@@ -108,43 +160,92 @@ CHANGES = [
     Rename("formplayer.metrics.requests", "formplayer.metrics.timings.count")
 ]
 
+MATCHER = RenameMatcher(CHANGES)
+
 def _get_args():
     parser = argparse.ArgumentParser(description='Print CSV data from by host query')
     parser.add_argument('--config', default='config.yml', help='Path to config file.')
     parser.add_argument('--update', action='store_true', help='Perform the update')
     parser.add_argument('--dashboard', help='Only process this dashboard')
+    parser.add_argument(
+        '--backup-dir', help='Where to write the backups and manifest when updating. Defaults to rename-TIMESTAMP.'
+    )
+    parser.add_argument('--resume', metavar='BACKUP_DIR', help='Apply the updates left over from a previous run.')
+    parser.add_argument(
+        '--diff-mode', choices=DIFF_MODES, default=DIFF_MODE,
+        help='Highlight the changes to each query by token or by character.'
+    )
+    add_mirror_args(parser)
+    add_replay_args(parser)
     return parser.parse_args()
 
 
-def inline_diff(a, b):
-    matcher = difflib.SequenceMatcher(None, a, b)
+def _get_token_opcodes(a, b):
+    """Opcodes as returned by ``SequenceMatcher.get_opcodes`` for two token lists.
+
+    Renames replace tokens one for one so when both have the same number of tokens
+    they are compared position by position in linear time. Otherwise only the part
+    between the common prefix and suffix is passed to ``SequenceMatcher``.
+    """
+    if len(a) == len(b):
+        opcodes = []
+        for i, (token_a, token_b) in enumerate(zip(a, b)):
+            tag = 'equal' if token_a == token_b else 'replace'
+            if opcodes and opcodes[-1][0] == tag:
+                opcodes[-1][2] = opcodes[-1][4] = i + 1
+            else:
+                opcodes.append([tag, i, i + 1, i, i + 1])
+        return opcodes
+
+    prefix = 0
+    while prefix < min(len(a), len(b)) and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < min(len(a), len(b)) - prefix and a[-1 - suffix] == b[-1 - suffix]:
+        suffix += 1
+
+    opcodes = [('equal', 0, prefix, 0, prefix)] if prefix else []
+    matcher = difflib.SequenceMatcher(None, a[prefix:len(a) - suffix], b[prefix:len(b) - suffix], autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        opcodes.append((tag, i1 + prefix, i2 + prefix, j1 + prefix, j2 + prefix))
+    if suffix:
+        opcodes.append(('equal', len(a) - suffix, len(a), len(b) - suffix, len(b)))
+    return opcodes
+
+
+def inline_diff(a, b, mode=None):
+    """Return ``a`` and ``b`` with the removed parts in red and the added parts in green"""
+    if (mode or DIFF_MODE) == 'char':
+        a_parts, b_parts = a, b
+        opcodes = difflib.SequenceMatcher(None, a, b).get_opcodes()
+    else:
+        a_parts, b_parts = DIFF_TOKEN_RE.findall(a), DIFF_TOKEN_RE.findall(b)
+        opcodes = _get_token_opcodes(a_parts, b_parts)
 
     def process_tag(tag, i1, i2, j1, j2):
+        old, new = ''.join(a_parts[i1:i2]), ''.join(b_parts[j1:j2])
         if tag == 'replace':
-            return colored.red(matcher.a[i1:i2]), colored.green(matcher.b[j1:j2])
+            return colored.red(old), colored.green(new)
         if tag == 'delete':
-            return colored.red(matcher.a[i1:i2]), ''
+            return colored.red(old), ''
         if tag == 'equal':
-            return matcher.a[i1:i2], matcher.a[i1:i2]
+            return old, old
         if tag == 'insert':
-            return '', colored.green(matcher.b[j1:j2])
+            return '', colored.green(new)
         assert False, "Unknown tag %r"%tag
 
-    parts = [process_tag(*t) for t in matcher.get_opcodes()]
+    parts = [process_tag(*t) for t in opcodes]
     l1, l2 = list(zip(*parts))
     return ''.join(str(p) for p in l1), ''.join(str(p) for p in l2)
 
 
-def _check_query(request, context):
-    attr = 'q'
+def _check_query(request, context, attr='q'):
     query = request[attr]
-    for change in itertools.chain.from_iterable(CHANGES):
-        new = change(query)
-        if new:
-            change.mark_seen()
-            diff_old, diff_new = inline_diff(query, new)
-            print('    "{}"\n\t{}\n\t{}\n'.format(context, diff_old, diff_new))
-            query = new
+    for change, new in MATCHER.iter_changes(query):
+        change.mark_seen()
+        diff_old, diff_new = inline_diff(query, new)
+        print('    "{}"\n\t{}\n\t{}\n'.format(context, diff_old, diff_new))
+        query = new
     if request[attr] != query:
         request[attr] = query
         return True
@@ -180,36 +281,151 @@ def process_widgets(widgets):
     return changed
 
 
+class Campaign(object):
+    """Backups of the dashboards and monitors being updated along with a manifest
+    of which updates have been applied so a partially applied campaign can be resumed"""
+    KINDS = ('dashboards', 'monitors')
+
+    def __init__(self, path):
+        self.path = path
+        self.manifest_path = os.path.join(path, 'manifest.json')
+        self.manifest = {kind: {} for kind in self.KINDS}
+
+    @classmethod
+    def load(cls, path):
+        campaign = cls(path)
+        with open(campaign.manifest_path) as f:
+            campaign.manifest = json.load(f)
+        return campaign
+
+    def _get_path(self, kind, object_id, version):
+        return os.path.join(self.path, kind, '{}.{}.json'.format(object_id, version))
+
+    def _write(self, path, data):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=4)
+        os.rename(tmp_path, path)
+
+    def create(self, updates):
+        """Write the backups for ``updates``, a list of ``(kind, name, original, updated)``"""
+        for kind in self.KINDS:
+            if not os.path.isdir(os.path.join(self.path, kind)):
+                os.makedirs(os.path.join(self.path, kind))
+        for kind, name, original, updated in updates:
+            object_id = str(original['id'])
+            self._write(self._get_path(kind, object_id, 'original'), original)
+            self._write(self._get_path(kind, object_id, 'updated'), updated)
+            self.manifest[kind][object_id] = {'name': name, 'status': 'pending'}
+        self.save()
+
+    def save(self):
+        self._write(self.manifest_path, self.manifest)
+
+    def get_pending(self):
+        """Return ``(kind, object_id)`` for each update that hasn't been applied"""
+        return [
+            (kind, object_id)
+            for kind in self.KINDS
+            for object_id, entry in sorted(self.manifest[kind].items())
+            if entry['status'] != 'done'
+        ]
+
+    def get_updated(self, kind, object_id):
+        with open(self._get_path(kind, object_id, 'updated')) as f:
+            return json.load(f)
+
+    def set_result(self, kind, object_id, error=None):
+        entry = self.manifest[kind][object_id]
+        entry['status'] = 'failed' if error else 'done'
+        entry['error'] = str(error) if error else None
+
+
+def _send_update(kind, updated):
+    if kind == 'dashboards':
+        updated.pop('author_name', None)
+        resp = api_call(api.Dashboard.update, **updated)
+    else:
+        resp = api_call(api.Monitor.update, updated['id'], query=updated['query'])
+    if 'errors' in resp:
+        raise Exception(resp['errors'])
+
+
+def apply_updates(campaign, workers):
+    """Send the pending updates of the campaign concurrently, recording the
+    result of each one in the manifest as it completes"""
+    pending = campaign.get_pending()
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(_send_update, kind, campaign.get_updated(kind, object_id)): (kind, object_id)
+            for kind, object_id in pending
+        }
+        for future in as_completed(futures):
+            kind, object_id = futures[future]
+            name = campaign.manifest[kind][object_id]['name']
+            error = future.exception()
+            campaign.set_result(kind, object_id, error)
+            campaign.save()
+            if error:
+                failed += 1
+                print(colored.red('Failed to update {} {} "{}": {}'.format(kind[:-1], object_id, name, error)))
+            else:
+                print(colored.green('Updated {} {} "{}"'.format(kind[:-1], object_id, name)))
+
+    print('{} updated, {} failed'.format(len(pending) - failed, failed))
+    if failed:
+        print('Retry the failed updates with --resume {}'.format(campaign.path))
+
+
+def plan_updates(mirror, dashboard_title=None):
+    """Print the changes to each dashboard and monitor and return the
+    ``(kind, name, original, updated)`` of the ones that changed"""
+    updates = []
+    for dashboard in mirror.iter_dashboards():
+        if dashboard_title and dashboard['title'] != dashboard_title:
+            continue
+        print('--------------------------------------------------------')
+        print(dashboard['title'])
+        dashboard_orig = json.loads(json.dumps(dashboard))
+        if process_widgets(dashboard['widgets']):
+            updates.append(('dashboards', dashboard['title'], dashboard_orig, dashboard))
+
+    if dashboard_title:
+        return updates
+
+    print('--------------------------------------------------------')
+    print('Monitors')
+    for monitor in mirror.iter_monitors():
+        monitor_orig = json.loads(json.dumps(monitor))
+        if _check_query(monitor, monitor['name'], attr='query'):
+            updates.append(('monitors', monitor['name'], monitor_orig, monitor))
+    return updates
+
+
 if __name__ == "__main__":
     args = _get_args()
     config = get_config(args.config)
     init_datadog(config)
-    dashboards = api.Dashboard.get_all()
-    for dashboard_info in dashboards['dashboards']:
-        if args.dashboard and dashboard_info['title'] != args.dashboard:
-            continue
-        print('--------------------------------------------------------')
-        print(dashboard_info['title'])
-        dashboard = api.Dashboard.get(dashboard_info['id'])
-        dashboard_orig = json.loads(json.dumps(dashboard))
-        widgets = dashboard['widgets']
-        changed = process_widgets(widgets)
-        if changed and args.update:
-            with open("{}-{}-{}.json".format(dashboard_info['id'], dashboard_info['title'], datetime.utcnow().isoformat()), 'w') as f:
-                json.dump(dashboard_orig, f, indent=4)
-            del dashboard['author_name']
-            resp = api.Dashboard.update(**dashboard)
-            if 'errors' in resp:
-                raise Exception(resp['errors'])
-
-    monitors = api.Monitor.get_all()
-    for monitor in monitors:
+    configure_replay(args)
+    DIFF_MODE = args.diff_mode
+
+    if args.resume:
+        campaign = Campaign.load(args.resume)
+    else:
+        if args.update and args.no_sync:
+            print('Ignoring --no-sync, updates are always made from freshly synced definitions')
+        # updates replace the whole definition so they must not be built from a stale copy
+        updates = plan_updates(get_mirror(args, force_sync=args.update), args.dashboard)
         for change in itertools.chain.from_iterable(CHANGES):
-            query = monitor['query']
-            if change.from_val in query:
-                print('Found in monitor: {}\n\t{}\n'.format(monitor['name'], query))
-            # api.Monitor.update(monitor['id'], query=)
-
-    for change in itertools.chain.from_iterable(CHANGES):
-        if not change.seen:
-            print("Change not found: {}".format(change))
+            if not change.seen:
+                print("Change not found: {}".format(change))
+
+        campaign = None
+        if args.update and updates:
+            campaign = Campaign(args.backup_dir or 'rename-{}'.format(datetime.utcnow().strftime('%Y%m%dT%H%M%S')))
+            campaign.create(updates)
+            print('Backups written to {}'.format(campaign.path))
+
+    if campaign:
+        apply_updates(campaign, args.workers)
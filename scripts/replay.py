@@ -0,0 +1,149 @@
+# Record / replay of datadog API requests.
+#
+# In record mode every request made through ``utils.api_call`` is saved to a
+# fixture directory. In replay mode the responses are served from that
+# directory instead of datadog so the scripts can run offline e.g.
+#
+#     python scripts/icds_success.py 1000 --record fixtures/icds
+#     python scripts/icds_success.py 1000 --replay fixtures/icds --replay-latency 0.2
+import hashlib
+import json
+import os
+import time
+
+import requests
+
+# never write credentials to the fixtures
+SECRET_KEYS = ('api_key', 'application_key', 'app_key')
+
+
+class ReplayMissing(Exception):
+    pass
+
+
+class ReplayResponse(object):
+    """Stand in for a ``requests.Response``, either for ``data`` or for a recorded body at ``body_path``"""
+    def __init__(self, data=None, status_code=200, body_path=None):
+        self.data = data
+        self.body_path = body_path
+        self.status_code = status_code
+        self.headers = {}
+        self.reason = 'OK'
+
+    def json(self):
+        if self.body_path:
+            with open(self.body_path, 'rb') as f:
+                return json.loads(f.read().decode('utf-8'))
+        return self.data
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        if self.body_path:
+            with open(self.body_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    yield chunk
+            return
+        content = json.dumps(self.data).encode('utf-8')
+        for i in range(0, len(content), chunk_size):
+            yield content[i:i + chunk_size]
+
+
+class RecordingResponse(object):
+    """Wraps a streamed ``requests.Response`` and writes its body to ``body_path`` as
+    the caller reads it. ``on_complete`` is called once the whole body is written."""
+    def __init__(self, response, body_path, on_complete):
+        self.response = response
+        self.body_path = body_path
+        self.on_complete = on_complete
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def json(self):
+        data = self.response.json()
+        with open(self.body_path, 'wb') as f:
+            f.write(json.dumps(data).encode('utf-8'))
+        self.on_complete()
+        return data
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        tmp_path = self.body_path + '.tmp'
+        chunks = self.response.iter_content(chunk_size)
+        with open(tmp_path, 'wb') as f:
+            try:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+            finally:
+                # record the whole body even if the caller stops reading early
+                for chunk in chunks:
+                    f.write(chunk)
+                f.close()
+                os.rename(tmp_path, self.body_path)
+                self.on_complete()
+
+
+def get_call_name(func):
+    """e.g. 'Metric.query' for ``api.Metric.query``"""
+    owner = getattr(func, '__self__', None)
+    if owner is None:
+        return func.__name__
+    owner_name = owner.__name__ if isinstance(owner, type) else type(owner).__name__
+    return '{}.{}'.format(owner_name, func.__name__)
+
+
+def _scrub(value):
+    if isinstance(value, dict):
+        return {key: _scrub(val) for key, val in value.items() if key not in SECRET_KEYS}
+    if isinstance(value, (list, tuple)):
+        return [_scrub(val) for val in value]
+    return value
+
+
+class ReplayStore(object):
+    def __init__(self, path, replaying=False, latency=0):
+        self.path = path
+        self.replaying = replaying
+        self.latency = latency
+
+    def _get_path(self, name, args, kwargs):
+        call = json.dumps([_scrub(args), _scrub(kwargs)], sort_keys=True, default=str)
+        return os.path.join(self.path, name, hashlib.sha1(call.encode('utf-8')).hexdigest() + '.json')
+
+    def record(self, func, args, kwargs, response):
+        """Save the response to a call and return it. An HTTP response is returned
+        wrapped so its body is recorded as it is streamed, rather than read up front."""
+        name = get_call_name(func)
+        path = self._get_path(name, args, kwargs)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        def _write(kind, data):
+            with open(path, 'w') as f:
+                json.dump({
+                    'call': name,
+                    'args': _scrub(args),
+                    'kwargs': _scrub(kwargs),
+                    'kind': kind,
+                    'response': data,
+                }, f, default=str)
+
+        if isinstance(response, requests.Response):
+            # the recording is only written once the body has been read completely
+            body_path = path[:-len('.json')] + '.body'
+            return RecordingResponse(response, body_path, lambda: _write('body', os.path.basename(body_path)))
+        _write('json', response)
+        return response
+
+    def replay(self, func, args, kwargs):
+        name = get_call_name(func)
+        path = self._get_path(name, args, kwargs)
+        if not os.path.exists(path):
+            raise ReplayMissing('No recording for {}(*{!r}, **{!r})'.format(name, _scrub(args), _scrub(kwargs)))
+        with open(path) as f:
+            recording = json.load(f)
+
+        if self.latency:
+            time.sleep(self.latency)
+        if recording['kind'] == 'body':
+            return ReplayResponse(body_path=os.path.join(os.path.dirname(path), recording['response']))
+        return recording['response']
@@ -3,14 +3,18 @@
 from __future__ import absolute_import
 
 import argparse
+import calendar
+import warnings
 from datetime import datetime, timedelta
-from itertools import izip_longest
 
+import numpy as np
 import pytz
-from datadog import api
 
 from const import ENV_TZ
+from series import Series
 from utils import get_date, get_config, init_datadog, adjust_datetime_to_utc
+from utils import add_query_args, configure_queries, query_local_rollups, query_range
+from utils import DAY_SECONDS, local_rollup_edges
 
 METRICS = {
     'all_requests': "sum:nginx.requests{{environment:{env}}}.as_count().rollup(sum, {rollup})",
@@ -28,70 +32,117 @@ METRICS = {
 }
 
 INTERVALS = {
-    # Even though we can set granularity, datadog has limit on max points it can return in a go
-    # see https://help.datadoghq.com/hc/en-us/articles/204526615-What-is-the-rollup-function-
+    # queries are split to stay under datadog's limit on points returned, see utils.MAX_QUERY_POINTS
     'hourly': 60 * 60,
     '15min': 15 * 60,
 }
 
+PERCENTILES = (50, 90, 99)
+
 def _get_args():
     parser = argparse.ArgumentParser(description='Print basic request success data')
     parser.add_argument('--config', default='config.yml', help='Path to config file.')
     parser.add_argument('--metric', choices=sorted(METRICS.keys()))
     parser.add_argument('-e', '--env', choices=ENV_TZ.keys(), required=True, help='Environment to query.')
     parser.add_argument('-d', '--duration', required=True, help='How many days to export')
-    parser.add_argument('-i', '--interval', default='hourly', choices=list(INTERVALS))
+    parser.add_argument(
+        '-i', '--interval', nargs='+', default=['hourly'], choices=list(INTERVALS),
+        help='Intervals to profile. With more than one the data is fetched once at the finest interval and rolled up '
+             'locally to the others, aligned to midnight in the environment timezone.'
+    )
 
+    add_query_args(parser)
     return parser.parse_args()
 
 
-def print_requests(env, metric, start, timezone, interval):
+def print_requests(env, metric, start, timezone, intervals):
     title = "Data for '%s' using timezone: '%s'" % (args.env.upper(), timezone)
     print(title)
     print("=" * len(title))
 
+    # whole days in the environment timezone up to the end of yesterday
     start_utc = adjust_datetime_to_utc(start, timezone)
+    end_utc = adjust_datetime_to_utc(datetime.today().replace(hour=0, minute=0, second=0, microsecond=0), timezone)
+    if start_utc >= end_utc:
+        return
+    edges = local_rollup_edges(_to_ms(start_utc), _to_ms(end_utc) - 1, DAY_SECONDS, timezone)
+    windows = list(zip(edges[:-1], edges[1:]))
+
+    if len(intervals) == 1:
+        query = METRICS[metric].format(env=env, rollup=INTERVALS[intervals[0]])
+        print(query)
+        series = query_range(query, start_utc, end_utc)['series']
+        _print_profile(series, windows, INTERVALS[intervals[0]], timezone)
+        return
+
+    rollups = query_local_rollups(
+        METRICS[metric], start_utc, end_utc, [INTERVALS[interval] for interval in intervals], timezone, env=env
+    )
+    for interval in intervals:
+        print('\n{}'.format(interval))
+        _print_profile(rollups[INTERVALS[interval]]['series'], windows, INTERVALS[interval], timezone)
+
+
+def _print_profile(series, windows, interval, timezone):
+    series = Series.from_pointlist(series[0]['pointlist'] if series else [])
+    matrix = get_profile(series, windows, interval)
+    local_days = [from_utc_to_tz(datetime.utcfromtimestamp(start / 1000), timezone) for start, _ in windows]
+
+    # only show days with data
+    has_data = ~np.isnan(matrix).all(axis=1)
+    matrix = matrix[has_data]
+    local_days = [day for day, keep in zip(local_days, has_data) if keep]
+    weekend = np.array([day.weekday() >= 5 for day in local_days], dtype=bool)
+    days = [day.strftime('%Y-%m-%d') for day in local_days]
+
+    print(','.join(['#'] + days))
+    for row in _get_profile_rows(matrix):
+        print(','.join(row))
+
+    ratios = get_peak_ratios(matrix)
+    for day, ratio in zip(days, ratios):
+        print(day, float(ratio))
+
+    for label, mask in (('Weekdays', ~weekend), ('Weekends', weekend)):
+        if not mask.any():
+            continue
+        print('\n{} ({} days), mean peak/total: {:.4f}'.format(label, int(mask.sum()), float(np.nanmean(ratios[mask]))))
+        print(','.join(['#'] + ['p{}'.format(percentile) for percentile in PERCENTILES]))
+        for row in _get_profile_rows(get_slot_percentiles(matrix[mask])):
+            print(','.join(row))
 
-    query = METRICS[metric]
-    query = query.format(env=env, rollup=INTERVALS[interval])
-    print(query)
 
-    data = []
-    start_day = start_utc
-    while start_day < adjust_datetime_to_utc(datetime.today() - timedelta(days=1) , timezone):
-        end_day = start_day + timedelta(days=1)
-        if end_day.weekday() == 6:
-            start_day += timedelta(days=1)
-            continue
+def _to_ms(value):
+    return calendar.timegm(value.timetuple()) * 1000
 
-        results = api.Metric.query(start=start_day.strftime('%s'), end=end_day.strftime('%s'), query=query)
-        series = results['series']
-        if not series:
-            start_day += timedelta(days=1)
-            continue
 
-        data.append([
-            (point[0], int(point[1]) if point[1] is not None else 0)
-            for point in series[0]['pointlist']
-        ])
+def get_profile(series, windows, interval):
+    """Days x slots matrix of ``series`` with a row for each ``(start, end)`` day
+    window (epoch ms) and a column for each ``interval`` seconds from the start
+    of the day. Missing slots are NaN."""
+    return series.to_matrix(windows, interval * 1000)
+
+
+def get_peak_ratios(matrix):
+    """Ratio of the busiest slot to the total for each day"""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.nanmax(matrix, axis=1) / np.nansum(matrix, axis=1)
+
 
-        start_day += timedelta(days=1)
+def get_slot_percentiles(matrix):
+    """``PERCENTILES`` x slots matrix of the percentiles of each slot across days"""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # slots without any data
+        return np.nanpercentile(matrix, PERCENTILES, axis=0)
 
-    heads = ['#'] + [
-        '{}'.format(from_utc_to_tz(datetime.utcfromtimestamp(day_points[0][0] / 1000), timezone).strftime('%Y-%m-%d')) for day_points in data
-    ]
-    print(','.join(heads))
-    for row_count, row in enumerate(izip_longest(*data)):
-        print(','.join([str(row_count)] + [
-            str(pair[1]) if pair else ''
-            for pair in row
-        ]))
 
-    for day in data:
-        vals = [r[1] for r in day]
-        val_max = max(vals)
-        val_sum = sum(vals)
-        print(from_utc_to_tz(datetime.utcfromtimestamp(day[0][0] / 1000), timezone).strftime('%Y-%m-%d'), float(val_max)/float(val_sum))
+def _get_profile_rows(matrix):
+    """One row per time slot with a column for each day"""
+    for row_count, row in enumerate(matrix.T.tolist()):
+        yield [str(row_count)] + [
+            str(int(value)) if value == value else ''  # NaN
+            for value in row
+        ]
 
 
 def from_utc_to_tz(date, tz):
@@ -106,5 +157,6 @@ if __name__ == "__main__":
 
     config = get_config(args.config)
     init_datadog(config)
+    configure_queries(args)
 
     print_requests(args.env, args.metric, start, ENV_TZ[args.env], args.interval)
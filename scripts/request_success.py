@@ -1,12 +1,14 @@
 from __future__ import absolute_import
+from __future__ import print_function
 
 import argparse
-from datetime import datetime
 
-from datadog import api
+import pytz
 
 from const import ENV_TZ
 from utils import get_date, get_config, init_datadog, adjust_datetime_to_utc
+from utils import add_join_args, add_query_args, add_source_args, configure_queries, format_epochs, join_result
+from utils import query_local_rollups, query_range
 
 METRICS = (
     ('request_count', "sum:nginx.requests{{environment:{env}}}.as_count().rollup(sum, {rollup})"),
@@ -23,8 +25,7 @@ METRICS = (
 )
 
 INTERVALS = {
-    # Even though we can set granularity, datadog has limit on max points it can return in a go
-    # see https://help.datadoghq.com/hc/en-us/articles/204526615-What-is-the-rollup-function-
+    # queries are split to stay under datadog's limit on points returned, see utils.MAX_QUERY_POINTS
     'hourly': 60 * 60,
     'daily': 60 * 60 * 24,
     '15min': 15 * 60,
@@ -36,32 +37,50 @@ def _get_args():
     parser.add_argument('-e', '--env', choices=ENV_TZ.keys(), required=True, help='Environment to query.')
     parser.add_argument('-s', '--start-date', required=True, help='Start date e.g. 2018-01-23')
     parser.add_argument('-f', '--end-date', required=True, help='End date e.g. 2018-01-23')
-    parser.add_argument('-i', '--interval', default='daily', choices=list(INTERVALS))
-
+    parser.add_argument(
+        '-i', '--interval', nargs='+', default=['daily'], choices=list(INTERVALS),
+        help='Intervals to report. With more than one the data is fetched once at the finest interval and rolled up '
+             'locally to the others, aligned to midnight in the environment timezone.'
+    )
+
+    add_join_args(parser)
+    add_source_args(parser)
+    add_query_args(parser)
     return parser.parse_args()
 
 
-def print_requests(env, start, end, timezone, interval):
+def print_requests(env, start, end, timezone, intervals, how='outer', fill=None):
     title = "Data for '%s' using timezone: '%s'" % (args.env.upper(), timezone)
     print(title)
     print("=" * len(title))
-    print(','.join(['Month'] + [m[0] for m in METRICS]))
 
     start_utc = adjust_datetime_to_utc(start, timezone)
     end_utc = adjust_datetime_to_utc(end, timezone)
 
     query = ', '.join([m[1] for m in METRICS])
-    query = query.format(env=env, rollup=INTERVALS[interval])
-
-    results = api.Metric.query(start=start_utc.strftime('%s'), end=end_utc.strftime('%s'), query=query)
-    data = results['series'][0].get('pointlist', [])
-    for i in range(0, len(data)):
-        posix_time = data[i][0]
-        datespan = datetime.utcfromtimestamp(posix_time / 1000).date()  # python datetime POSIX TZ issue
-        print ", ".join([str(datespan)] + [
-            '{}'.format(int(series['pointlist'][i][1]) if series['pointlist'][i][1] is not None else '---')
-            for series in results['series']
-        ])
+    if len(intervals) == 1:
+        rollup = INTERVALS[intervals[0]]
+        results = query_range(query.format(env=env, rollup=rollup), start_utc, end_utc, rollup=rollup)
+        print(','.join(['Month'] + [m[0] for m in METRICS]))
+        _print_rows(join_result(results, how, fill), lambda timestamps: format_epochs(timestamps, pytz.utc))
+        return
+
+    rollups = query_local_rollups(
+        query, start_utc, end_utc, [INTERVALS[interval] for interval in intervals], timezone, env=env
+    )
+    for interval in intervals:
+        date_format = '%Y-%m-%d' if INTERVALS[interval] >= INTERVALS['daily'] else '%Y-%m-%d %H:%M'
+        print('\n{}'.format(interval))
+        print(','.join(['Month'] + [m[0] for m in METRICS]))
+        _print_rows(
+            join_result(rollups[INTERVALS[interval]], how, fill),
+            lambda timestamps: format_epochs(timestamps, timezone, date_format)
+        )
+
+
+def _print_rows(table, format_times):
+    for row in table.iter_rows(format_times, '%d', missing='---'):
+        print(", ".join(row))
 
 
 if __name__ == "__main__":
@@ -71,7 +90,9 @@ if __name__ == "__main__":
     month_start = get_date(args.start_date)
     month_end = get_date(args.end_date)
 
-    config = get_config(args.config)
-    init_datadog(config)
+    if args.source != 'local':  # the warehouse answers without datadog
+        config = get_config(args.config)
+        init_datadog(config)
+    configure_queries(args)
 
-    print_requests(args.env, month_start, month_end, ENV_TZ[args.env], args.interval)
+    print_requests(args.env, month_start, month_end, ENV_TZ[args.env], args.interval, args.join, args.fill)
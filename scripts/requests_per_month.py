@@ -3,11 +3,16 @@ from __future__ import print_function
 import argparse
 from datetime import datetime, timedelta
 
-from datadog import api
 from dateutil.relativedelta import relativedelta
 
 from const import ENV_TZ
+from series import Series
 from utils import get_date, get_config, init_datadog, adjust_datetime_to_utc
+from utils import add_query_args, add_source_args, configure_queries, query_metric
+
+# the warehouse can only store data at a fixed rollup so the integral is taken locally from hourly averages
+LOCAL_INTERVAL = 60 * 60
+LOCAL_QUERY = "avg:nginx.requests{{environment:{env}}}.rollup(avg, %d)" % LOCAL_INTERVAL
 
 
 def _get_args():
@@ -17,10 +22,12 @@ def _get_args():
     parser.add_argument('-f', '--month-end', required=True, help='Month to end e.g. Sep or September')
     parser.add_argument('--config', default='config.yml', help='Path to config file.')
 
+    add_source_args(parser)
+    add_query_args(parser)
     return parser.parse_args()
 
 
-def print_requests(env, month_start, month_end, timezone):
+def print_requests(env, month_start, month_end, timezone, source='datadog'):
     title = "Data for '%s' using timezone: '%s'" % (args.env.upper(), timezone)
     print(title)
     print("=" * len(title))
@@ -32,11 +39,17 @@ def print_requests(env, month_start, month_end, timezone):
             start, timezone
         )
         end_utc = start + relativedelta(months=1) - timedelta(seconds=1)
-        query = "integral(avg:nginx.requests{environment:%s})" % args.env
-        results = api.Metric.query(start=start_utc.strftime('%s'), end=end_utc.strftime('%s'), query=query)
-        data = results['series'][0].get('pointlist', [])
+        if source == 'local':
+            results = query_metric(LOCAL_QUERY.format(env=env), start_utc, end_utc)
+            points = Series.from_pointlist(results['series'][0]['pointlist'] if results['series'] else [])
+            total = points.sum() * LOCAL_INTERVAL
+        else:
+            query = "integral(avg:nginx.requests{environment:%s})" % args.env
+            results = query_metric(query, start_utc, end_utc)
+            data = results['series'][0].get('pointlist', [])
+            total = data[-1][1]
 
-        print("%s,%s" % (start.strftime('%b'), int(data[-1][1])))
+        print("%s,%s" % (start.strftime('%b'), int(total)))
 
 
 if __name__ == "__main__":
@@ -46,7 +59,9 @@ if __name__ == "__main__":
     month_start = get_date(args.month_start).month
     month_end = get_date(args.month_end).month
 
-    config = get_config(args.config)
-    init_datadog(config)
+    if args.source != 'local':  # the warehouse answers without datadog
+        config = get_config(args.config)
+        init_datadog(config)
+    configure_queries(args)
 
-    print_requests(args.env, month_start, month_end, ENV_TZ[args.env])
+    print_requests(args.env, month_start, month_end, ENV_TZ[args.env], args.source)
@@ -0,0 +1,297 @@
+from __future__ import division
+
+from itertools import chain
+
+import numpy as np
+
+
+def _pointlist_arrays(pointlist):
+    points = np.array(pointlist, dtype=np.float64).reshape(-1, 2)  # None -> NaN
+    return points[:, 0].astype(np.int64), points[:, 1]
+
+
+class Series(object):
+    """A single series of points held as an int64 array of timestamps (epoch ms)
+    and a float64 array of values with NaN for missing values"""
+    __slots__ = ('timestamps', 'values')
+
+    def __init__(self, timestamps, values):
+        self.timestamps = timestamps
+        self.values = values
+
+    @classmethod
+    def from_pointlist(cls, pointlist):
+        return cls(*_pointlist_arrays(pointlist))
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def to_pointlist(self):
+        return [
+            [int(ts), None if np.isnan(value) else float(value)]
+            for ts, value in zip(self.timestamps, self.values)
+        ]
+
+    def max(self):
+        return _nan_reduce(np.nanmax, self.values)
+
+    def min(self):
+        return _nan_reduce(np.nanmin, self.values)
+
+    def sum(self):
+        return float(np.nansum(self.values))
+
+    def mean(self):
+        return _nan_reduce(np.nanmean, self.values)
+
+    def argmax(self, last=True):
+        """(timestamp, value) of the largest value or None if there are no values.
+        Ties go to the latest point, or to the earliest one if ``last`` is unset."""
+        if np.isnan(self.values).all():
+            return None
+        if last:
+            index = len(self.values) - 1 - int(np.nanargmax(self.values[::-1]))
+        else:
+            index = int(np.nanargmax(self.values))
+        return int(self.timestamps[index]), float(self.values[index])
+
+    def top(self, k):
+        """The ``k`` largest values as (timestamp, value) pairs, largest first"""
+        valid = np.flatnonzero(~np.isnan(self.values))
+        if k <= 0 or not len(valid):
+            return []
+        if len(valid) > k:
+            # keep everything tied with the k-th largest so ties go to the earliest points
+            threshold = -np.partition(-self.values[valid], k - 1)[k - 1]
+            valid = valid[self.values[valid] >= threshold]
+        order = valid[np.lexsort((self.timestamps[valid], -self.values[valid]))][:k]
+        return [(int(self.timestamps[i]), float(self.values[i])) for i in order]
+
+    def to_matrix(self, windows, interval):
+        """Arrange the points in a matrix with a row for each ``(start, end)`` window
+        (epoch ms, ascending and not overlapping) and a column for each ``interval`` ms
+        slot from the start of the window. Slots without a value are NaN."""
+        starts = np.array([start for start, _ in windows], dtype=np.int64)
+        ends = np.array([end for _, end in windows], dtype=np.int64)
+        slots = int(-(-(ends - starts).max() // interval)) if len(windows) else 0
+        matrix = np.full((len(windows), slots), np.nan)
+        if not len(windows):
+            return matrix
+        rows = np.searchsorted(starts, self.timestamps, side='right') - 1
+        inside = (rows >= 0) & (self.timestamps < ends[np.maximum(rows, 0)])
+        rows = rows[inside]
+        columns = (self.timestamps[inside] - starts[rows]) // interval
+        matrix[rows, columns] = self.values[inside]
+        return matrix
+
+    def split(self, edges):
+        """Split the series at ``edges`` (epoch ms, ascending) into a ``SeriesStore``
+        with one series per window between consecutive edges, keyed by the start
+        of the window. Points outside the edges are dropped."""
+        edges = np.asarray(edges, dtype=np.int64)
+        bounds = np.searchsorted(self.timestamps, edges)
+        first, last = bounds[0], bounds[-1]
+        return SeriesStore(
+            edges[:-1].tolist(), self.timestamps[first:last], self.values[first:last], bounds - first
+        )
+
+    def resample(self, interval, how='sum', origin=0):
+        """Roll the series up into buckets of ``interval`` ms starting from ``origin``
+        (epoch ms). Buckets without any values are dropped."""
+        if not len(self):
+            return Series(self.timestamps, self.values)
+        start = origin + (int(self.timestamps[0]) - origin) // interval * interval
+        edges = np.arange(start, int(self.timestamps[-1]) + interval + 1, interval)
+        return self.split(edges).to_series(how)
+
+    def rolling_sum(self, window, interval):
+        """Sum of the values in each ``window`` ms starting at each point of a
+        series with points every ``interval`` ms, missing values counting as 0.
+        Only windows that end within the series are included."""
+        cumsum = np.concatenate([[0], np.cumsum(np.nan_to_num(self.values))])
+        count = np.searchsorted(self.timestamps, self.timestamps[-1] - window + interval, side='right') \
+            if len(self) else 0
+        ends = np.searchsorted(self.timestamps, self.timestamps[:count] + window)
+        return Series(self.timestamps[:count], cumsum[ends] - cumsum[:count])
+
+
+def _nan_reduce(func, values):
+    if np.isnan(values).all():
+        return None
+    return float(func(values))
+
+
+class SeriesStore(object):
+    """Columnar store for many series.
+
+    The points of all series are concatenated into one timestamp array and one
+    value array. Each series is identified by a tuple of tag values e.g.
+    ``('host1', '/opt/data')`` and reductions are computed for all series in
+    a single vectorized pass.
+    """
+
+    def __init__(self, keys, timestamps, values, offsets):
+        self.keys = list(keys)
+        self.timestamps = timestamps
+        self.values = values
+        self.offsets = offsets  # start of each series, with a final entry for the end
+        self._index = {key: i for i, key in enumerate(self.keys)}
+
+    @classmethod
+    def from_pointlists(cls, items):
+        """Build a store from ``(key, pointlist)`` pairs"""
+        keys = []
+        pointlists = []
+        for key, pointlist in items:
+            keys.append(key)
+            pointlists.append(pointlist)
+        offsets = np.zeros(len(pointlists) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(pointlist) for pointlist in pointlists])
+        timestamps, values = _pointlist_arrays(list(chain.from_iterable(pointlists)))
+        return cls(keys, timestamps, values, offsets)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def __getitem__(self, key):
+        i = self._index[key]
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return Series(self.timestamps[start:end], self.values[start:end])
+
+    def items(self):
+        for key in self.keys:
+            yield key, self[key]
+
+    def _reduce(self, ufunc, values, empty):
+        """Apply ``ufunc`` to each series. ``empty`` is used for series with no points."""
+        starts = self.offsets[:-1]
+        lengths = np.diff(self.offsets)
+        result = np.full(len(self.keys), empty, dtype=np.float64)
+        non_empty = lengths > 0
+        if non_empty.any():
+            # reduceat can't handle empty segments so only pass the start of non-empty series
+            result[non_empty] = ufunc.reduceat(values, starts[non_empty])
+        return result
+
+    def _counts(self):
+        return self._reduce(np.add, (~np.isnan(self.values)).astype(np.float64), 0)
+
+    def reduce(self, how):
+        """Array with one value per series, ``how`` being one of 'max', 'min', 'sum' or 'mean'.
+        The sum is 0 for series without any values and the others are NaN."""
+        if how == 'max':
+            return self._reduce(np.fmax, self.values, np.nan)
+        if how == 'min':
+            return self._reduce(np.fmin, self.values, np.nan)
+        sums = self._reduce(np.add, np.nan_to_num(self.values), 0)
+        if how == 'sum':
+            return sums
+        if how == 'mean':
+            counts = self._counts()
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return np.where(counts > 0, sums / counts, np.nan)
+        raise ValueError('Unknown reduction: {}'.format(how))
+
+    def to_series(self, how='sum'):
+        """A ``Series`` of the reduction of each series, timestamped with their
+        keys (e.g. the stores from ``Series.split``). Series without values are dropped."""
+        values = self.reduce(how)
+        keep = self._counts() > 0
+        return Series(np.asarray(self.keys, dtype=np.int64)[keep], values[keep])
+
+    def _as_dict(self, result):
+        return {
+            key: None if np.isnan(value) else float(value)
+            for key, value in zip(self.keys, result)
+        }
+
+    def max(self):
+        return self._as_dict(self.reduce('max'))
+
+    def min(self):
+        return self._as_dict(self.reduce('min'))
+
+    def sum(self):
+        return self._as_dict(self.reduce('sum'))
+
+    def mean(self):
+        return self._as_dict(self.reduce('mean'))
+
+    def argmax(self):
+        """Map of key to the (timestamp, value) of the largest value in each series,
+        ties go to the latest point like ``Series.argmax``"""
+        maxes = self._reduce(np.fmax, self.values, np.nan)
+        lengths = np.diff(self.offsets)
+        series_index = np.repeat(np.arange(len(self.keys)), lengths)
+        # the last point in each series that equals its max
+        positions = np.flatnonzero(self.values == maxes[series_index])[::-1]
+        found, last_index = np.unique(series_index[positions], return_index=True)
+        last = dict(zip(found.tolist(), positions[last_index].tolist()))
+        return {
+            key: (int(self.timestamps[last[i]]), float(self.values[last[i]])) if i in last else None
+            for i, key in enumerate(self.keys)
+        }
+
+
+class Table(object):
+    """Many series joined on their timestamps: a sorted ``timestamps`` array and a
+    ``values`` matrix with a row per timestamp and a column per series"""
+
+    def __init__(self, timestamps, values):
+        self.timestamps = timestamps
+        self.values = values
+
+    @classmethod
+    def join(cls, series, how='outer', fill=np.nan):
+        """Join a list of ``Series``. An 'outer' join has a row for every timestamp
+        in any of the series and an 'inner' join only for those in all of them.
+        Timestamps missing from a series are given ``fill``, values that are
+        missing (None) in a series stay NaN."""
+        if how not in ('outer', 'inner'):
+            raise ValueError('Unknown join: {}'.format(how))
+        if not series:
+            return cls(np.zeros(0, dtype=np.int64), np.zeros((0, 0)))
+
+        # sort all the timestamps once rather than merging the series one at a time
+        timestamps = np.unique(np.concatenate([other.timestamps for other in series]))
+        values = np.full((len(timestamps), len(series)), np.nan if fill is None else fill, dtype=np.float64)
+        found = np.zeros(values.shape, dtype=bool)
+        for column, other in enumerate(series):
+            positions = np.searchsorted(timestamps, other.timestamps)
+            values[positions, column] = other.values
+            found[positions, column] = True
+        if how == 'inner':
+            in_all = found.all(axis=1)
+            timestamps, values = timestamps[in_all], values[in_all]
+        return cls(timestamps, values)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def map(self, func):
+        """A table with ``func`` applied to the values matrix"""
+        return Table(self.timestamps, func(self.values))
+
+    def iter_rows(self, format_times=None, value_format='%s', missing=''):
+        """Yield each row as a list of strings, the timestamp followed by the values
+        formatted with ``value_format`` or ``missing`` for NaN. ``format_times`` is
+        given the array of timestamps and returns a list of strings for them,
+        e.g. ``utils.format_epochs``."""
+        times = format_times(self.timestamps) if format_times else self.timestamps.astype(str).tolist()
+        # values repeat a lot, format each distinct one once like ``utils.format_epochs``
+        nan = np.isnan(self.values)
+        distinct, positions = np.unique(self.values[~nan], return_inverse=True)
+        formatted = np.array([value_format % value for value in distinct.tolist()] + [missing], dtype=object)
+        cells = np.full(self.values.shape, len(distinct), dtype=np.int64)
+        cells[~nan] = positions.reshape(-1)
+        rows = np.empty((len(self.timestamps), self.values.shape[1] + 1), dtype=object)
+        rows[:, 0] = times
+        rows[:, 1:] = formatted[cells]
+        for row in rows.tolist():
+            yield row
@@ -3,15 +3,15 @@ from __future__ import print_function
 import argparse
 from datetime import datetime, timedelta
 
-from datadog import api
-
 from utils import get_config, init_datadog
+from utils import add_query_args, configure_queries, query_metric
 
 
 def _get_args():
     parser = argparse.ArgumentParser(description='Print breakdown of Sync Intervals')
     parser.add_argument('--config', default='config.yml', help='Path to config file.')
 
+    add_query_args(parser)
     return parser.parse_args()
 
 
@@ -27,7 +27,7 @@ def print_requests():
         query = ("100 * sum:commcare.restore.sync_interval{environment:%s} by {days_since_last}.as_count() "
                  "/ sum:commcare.restore.sync_interval{environment:%s}.as_count()" % (env, env))
 
-        results = api.Metric.query(start=start.strftime('%s'), end=end.strftime('%s'), query=query)
+        results = query_metric(query, start, end)
         for series in results['series']:
             scope = [s for s in series['scope'].split(',') if s.startswith('days_since_last')][0]
             scope = scope.split(':')[1]
@@ -46,5 +46,6 @@ if __name__ == "__main__":
     args = _get_args()
     config = get_config(args.config)
     init_datadog(config)
+    configure_queries(args)
 
     print_requests()
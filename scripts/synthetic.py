@@ -0,0 +1,232 @@
+# Generate datadog shaped payloads for a synthetic fleet of hosts.
+#
+# Used to load test the scripts without a real environment:
+#
+#     python scripts/machine_sizes.py -c config.yml --env-name icds -d 7 --synthetic 10000
+#
+# or to look at a generated payload directly:
+#
+#     python scripts/synthetic.py 'max:system.mem.used{environment:icds}by{host}.rollup(max, 3600)' --hosts 100
+from __future__ import division
+
+import argparse
+import json
+import re
+import time
+import zlib
+
+import numpy as np
+
+from replay import ReplayMissing, ReplayResponse, get_call_name
+from utils import MAX_QUERY_POINTS, get_rollup_interval, split_queries
+
+METRIC_RE = re.compile(r'(\w+):([\w.]+)\s*\{([^}]*)\}')
+GROUP_BY_RE = re.compile(r'by\s*\{([^}]*)\}')
+FILTER_RE = re.compile(r'environment:([\w-]+)')
+
+DEVICES = (
+    '/opt/data', '/', '/opt/data1', '/opt_new', '100.71.188.44:/opt/shared_icds',
+    '/var/log', '/opt/tmp', '/mnt/backup',
+)
+
+ROLES = ('web', 'celery', 'pg', 'couch', 'es', 'kafka', 'redis', 'proxy', 'formplayer', 'riak')
+
+TAG_VALUES = {
+    'days_since_last': ('initial', 'lt_002d', 'lt_007d', 'lt_014d', 'lt_028d', 'over_028d'),
+    'url_group': ('receiver', 'phone/restore', 'phone/heartbeat', 'apps', 'mm/audio', 'mm/video', 'mm/image'),
+    'status_code': ('200', '201', '202', '301', '302', '401', '412', '500', '503'),
+}
+
+GB = 1024 ** 3
+
+
+class SyntheticFleet(object):
+    """Deterministic fake data for ``hosts`` hosts per environment, each with
+    ``devices`` disks. Points are generated at ``resolution`` seconds unless
+    the query asks for a rollup and ``gap_rate`` of them are None."""
+
+    def __init__(self, hosts=100, devices=4, resolution=60, gap_rate=0.01, seed=0):
+        self.hosts = hosts
+        self.devices = DEVICES[:max(1, min(devices, len(DEVICES)))]
+        self.resolution = resolution
+        self.gap_rate = gap_rate
+        self.seed = seed
+        self._hosts_by_env = {}
+
+    def get_hosts(self, env):
+        if env not in self._hosts_by_env:
+            self._hosts_by_env[env] = [
+                '{}-{}{:04d}'.format(env, ROLES[i % len(ROLES)], i // len(ROLES))
+                for i in range(self.hosts)
+            ]
+        return self._hosts_by_env[env]
+
+    def _key(self, *key):
+        return zlib.crc32(repr((self.seed,) + key).encode('utf-8'))
+
+    def _rng(self, *key):
+        return np.random.default_rng(self._key(*key))
+
+    def _uniform(self, timestamps, *key):
+        """Values in [0, 1) that only depend on ``key`` and each timestamp, so the
+        same point comes back whatever window it is queried in"""
+        x = timestamps.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15) + np.uint64(self._key(*key))
+        with np.errstate(over='ignore'):
+            # splitmix64 finalizer
+            x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+            x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        x = x ^ (x >> np.uint64(31))
+        return (x >> np.uint64(11)) / float(2 ** 53)
+
+    def _host_specs(self, host):
+        rng = self._rng('specs', host)
+        memory_gb = int(rng.choice([4, 8, 16, 32, 64, 128]))
+        return {
+            'memory_gb': memory_gb,
+            'swap_gb': int(rng.choice([0, 1, 2, 4])),
+            'cpus': int(rng.choice([2, 4, 8, 16, 32])),
+            'disk_kb': {device: int(rng.integers(20, 2000)) * 1024 ** 2 for device in self.devices},
+        }
+
+    def infra_overview(self, env):
+        rows = []
+        for host in self.get_hosts(env):
+            specs = self._host_specs(host)
+            gohai = {
+                'memory': {
+                    'total': '{}kB'.format(specs['memory_gb'] * 1024 ** 2),
+                    'swap_total': '{}kB'.format(specs['swap_gb'] * 1024 ** 2),
+                },
+                'cpu': {'cpu_logical_processors': str(specs['cpus'])},
+                'filesystem': [
+                    {'name': device.split(':')[-1], 'mounted_on': device.split(':')[-1], 'kb_size': str(kb_size)}
+                    for device, kb_size in sorted(specs['disk_kb'].items())
+                ] + [{'name': 'tmpfs', 'mounted_on': '/dev/shm', 'kb_size': '1024'}],
+            }
+            rows.append({'host_name': host, 'meta': {'gohai': json.dumps(gohai)}})
+        return {'rows': rows}
+
+    def _get_groups(self, env, group_by):
+        groups = [{}]
+        for tag in group_by:
+            if tag == 'host':
+                values = self.get_hosts(env)
+            elif tag == 'device':
+                values = self.devices
+            else:
+                values = TAG_VALUES.get(tag, tuple('{}_{}'.format(tag, i) for i in range(5)))
+            groups = [dict(group, **{tag: value}) for group in groups for value in values]
+        return groups
+
+    def _get_interval(self, rollup, start, end):
+        interval = rollup or self.resolution
+        # like datadog, return fewer points at a coarser interval if there would be too many
+        multiple = -(-(end - start) // (interval * MAX_QUERY_POINTS))
+        return interval * max(1, multiple)
+
+    def _values(self, metric, key, timestamps, interval):
+        daily = 0.5 + 0.5 * np.sin(2 * np.pi * (timestamps % 86400) / 86400)
+        noise = self._uniform(timestamps, 'noise', metric, key)
+        level = self._rng('level', metric, key).random()
+        if metric == 'system.cpu.idle':
+            values = 100 - 100 * np.clip(0.1 + 0.6 * level * daily + 0.2 * noise, 0, 1)
+        elif metric in ('system.mem.used', 'system.swap.used'):
+            values = (0.2 + 0.6 * level + 0.1 * noise) * 16 * GB
+        elif metric == 'system.disk.in_use':
+            values = np.clip(0.2 + 0.6 * level + 0.02 * noise, 0, 1)
+        elif metric == 'system.disk.used':
+            values = (0.2 + 0.6 * level + 0.02 * noise) * 500 * GB
+        else:
+            # request counts
+            values = np.floor((10 + 1000 * level * daily) * (0.8 + 0.4 * noise) * interval / 60)
+        return values
+
+    def query(self, start, end, query):
+        start, end = int(start), int(end)
+        series = []
+        for query_index, expression in enumerate(split_queries(query)):
+            metrics = METRIC_RE.findall(expression)
+            if not metrics:
+                continue
+            _, metric, filters = metrics[0]
+            env_match = FILTER_RE.search(filters)
+            env = env_match.group(1) if env_match else 'synthetic'
+            group_by = []
+            for group in GROUP_BY_RE.findall(expression):
+                group_by.extend(tag.strip() for tag in group.split(',') if tag.strip())
+
+            interval = self._get_interval(get_rollup_interval(expression), start, end)
+            timestamps = np.arange(start - start % interval, end + 1, interval)
+            for group in self._get_groups(env, group_by):
+                scope = ','.join('{}:{}'.format(tag, group[tag]) for tag in sorted(group)) or filters.strip() or '*'
+                values = self._values(metric, (env, scope), timestamps, interval)
+                gaps = self._uniform(timestamps, 'gaps', metric, env, scope) < self.gap_rate
+                pointlist = [
+                    [ts * 1000, None if gap else value]
+                    for ts, value, gap in zip(timestamps.tolist(), values.tolist(), gaps.tolist())
+                ]
+                item = {
+                    'metric': metric,
+                    'expression': expression,
+                    'scope': scope,
+                    'query_index': query_index,
+                    'interval': interval,
+                    'length': len(pointlist),
+                    'start': start * 1000,
+                    'end': end * 1000,
+                    'pointlist': pointlist,
+                }
+                if expression.startswith('top('):
+                    item['attributes'] = {'top': {'value': [float(np.nansum(values))]}}
+                series.append(item)
+
+        return {
+            'status': 'ok',
+            'res_type': 'time_series',
+            'query': query,
+            'from_date': start * 1000,
+            'to_date': end * 1000,
+            'series': series,
+        }
+
+
+class SyntheticApi(object):
+    """Stand in for the datadog API serving data from a ``SyntheticFleet``.
+    Used in place of a ``replay.ReplayStore`` by ``utils.api_call``."""
+    replaying = True
+
+    def __init__(self, fleet, latency=0):
+        self.fleet = fleet
+        self.latency = latency
+
+    def replay(self, func, args, kwargs):
+        name = get_call_name(func)
+        if self.latency:
+            time.sleep(self.latency)
+        if name == 'Metric.query':
+            return self.fleet.query(**kwargs)
+        if name == 'Session.request':  # infrastructure overview
+            env = kwargs['params']['tags'].split(':', 1)[1]
+            return ReplayResponse(self.fleet.infra_overview(env))
+        if name == 'Dashboard.get_all':
+            return {'dashboards': []}
+        if name == 'Monitor.get_all':
+            return []
+        raise ReplayMissing('No synthetic data for {}'.format(name))
+
+
+def _get_args():
+    parser = argparse.ArgumentParser(description='Print a synthetic response for a metric query')
+    parser.add_argument('query', help='Datadog query string')
+    parser.add_argument('--hosts', type=int, default=100, help='Number of hosts in the fleet.')
+    parser.add_argument('--devices', type=int, default=4, help='Number of disks per host.')
+    parser.add_argument('--resolution', type=int, default=60, help='Resolution of the data in seconds.')
+    parser.add_argument('--days', type=int, default=1, help='How many days of data to generate.')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = _get_args()
+    fleet = SyntheticFleet(args.hosts, args.devices, args.resolution)
+    end = int(time.time())
+    print(json.dumps(fleet.query(end - args.days * 86400, end, args.query)))
@@ -1,13 +1,17 @@
 from __future__ import print_function
 
 import argparse
-from datetime import datetime, timedelta
+from datetime import timedelta
 
-from datadog import api
+import numpy as np
+import pytz
 from dateutil.relativedelta import relativedelta
 
 from const import ENV_TZ
 from utils import get_date, get_config, init_datadog, adjust_datetime_to_utc
+from series import Series, Table
+from utils import add_join_args, add_query_args, add_source_args, configure_queries, format_epochs
+from utils import query_metric
 
 ENV_DISKS = {
     'icds': ['/opt/data', '/opt/data1', '/opt_new'],
@@ -30,33 +34,36 @@ def _get_args():
     parser.add_argument('-f', '--month-end', required=True, help='Month to end e.g. Sep or September')
     parser.add_argument('--config', default='config.yml', help='Path to config file.')
 
+    add_join_args(parser)
+    add_source_args(parser)
+    add_query_args(parser)
     return parser.parse_args()
 
 
-def print_requests(envs, month_start, month_end):
-    query = []
-    for env in envs:
-        env_query = []
-        devices = ENV_DISKS.get(env, ['/opt/data'])
-        for device in devices:
-            env_query.append("sum:system.disk.used{{environment:{},device:{}}}.rollup(avg, 2592000)".format(env, device))
-        query.append(' + '.join(env_query))
+def get_query(env):
+    devices = ENV_DISKS.get(env, ['/opt/data'])
+    return ' + '.join(
+        "sum:system.disk.used{{environment:{},device:{}}}.rollup(avg, 2592000)".format(env, device)
+        for device in devices
+    )
 
-    results = api.Metric.query(start=month_start.strftime('%s'), end=month_end.strftime('%s'), query=','.join(query))
-    data = results['series'][0].get('pointlist', [])
+
+def print_requests(envs, month_start, month_end, how='outer', fill=None):
+    query = [get_query(env) for env in envs]
+    results = query_metric(','.join(query), month_start, month_end)
     senvs = [
         _get_env(series)
         for series in results['series']
     ]
     headers = ['Month'] + ['Avg data on "{}" (TB)'.format(env) for env in senvs]
     print(','.join(headers))
-    for i in range(0, len(data)):
-        posix_time = data[i][0]
-        datespan = datetime.utcfromtimestamp(posix_time / 1000).date()  # python datetime POSIX TZ issue
-        print(", ".join([str(datespan)] + [
-            '{}'.format(int(series['pointlist'][i][1]) / 1000000000000 if series['pointlist'][i][1] is not None else '---')
-            for series in results['series']
-        ]))
+    # scale to TB before joining so that ``fill`` is printed as given
+    table = Table.join([
+        Series(series.timestamps, np.trunc(series.values) / 1000000000000)
+        for series in map(Series.from_pointlist, [item.get('pointlist', []) for item in results['series']])
+    ], how, fill)
+    for row in table.iter_rows(lambda timestamps: format_epochs(timestamps, pytz.utc), missing='---'):
+        print(", ".join(row))
 
 
 if __name__ == "__main__":
@@ -66,7 +73,9 @@ if __name__ == "__main__":
     month_start = get_date(args.month_start)
     month_end = get_date(args.month_end)
 
-    config = get_config(args.config)
-    init_datadog(config)
+    if args.source != 'local':  # the warehouse answers without datadog
+        config = get_config(args.config)
+        init_datadog(config)
+    configure_queries(args)
 
-    print_requests(args.env, month_start, month_end)
+    print_requests(args.env, month_start, month_end, args.join, args.fill)
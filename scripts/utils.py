@@ -1,12 +1,70 @@
 from __future__ import print_function
 
 import argparse
-from collections import defaultdict
-from datetime import datetime
+import calendar
+import codecs
+import functools
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
 
+import numpy as np
 import pytz
+import requests
 import yaml
-from datadog import initialize
+from datadog import api, initialize
+from datadog.api.exceptions import ApiError, ClientError, HttpBackoff, HttpTimeout, HTTPError
+
+from replay import ReplayStore
+from series import Series, SeriesStore, Table
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'metrics_analysis')
+DEFAULT_CACHE_MAX_BYTES = 512 * 1024 ** 2
+DEFAULT_WAREHOUSE_DIR = os.path.join(DEFAULT_CACHE_DIR, 'warehouse')
+
+# windows ending less than this long ago may still receive late data points
+CACHE_SETTLE_SECONDS = 60 * 60
+# how long results for windows that are still open are considered fresh
+CACHE_OPEN_WINDOW_TTL = 5 * 60
+# eviction trims the cache to this fraction of its limit so it doesn't run again on the next write
+CACHE_EVICT_TO = 0.9
+
+DEFAULT_WORKERS = 4
+# maximum number of comma separated expressions to send in a single query
+DEFAULT_BATCH_SIZE = 10
+
+# Even though we can set granularity, datadog has limit on max points it can return in a go
+# see https://help.datadoghq.com/hc/en-us/articles/204526615-What-is-the-rollup-function-
+MAX_QUERY_POINTS = 1500
+
+DAY_SECONDS = 24 * 60 * 60
+
+# number of distinct series scopes to keep parsed, a few times the series in a large by host query
+SCOPE_CACHE_SIZE = 64 * 1024
+
+# the finest unit shown by each strftime directive, formats without any of these show days
+FORMAT_RESOLUTION_MS = (
+    ('%f', 1), ('%S', 1000), ('%T', 1000), ('%X', 1000), ('%c', 1000), ('%r', 1000),
+    ('%M', 60 * 1000), ('%R', 60 * 1000), ('%H', 60 * 60 * 1000), ('%I', 60 * 60 * 1000), ('%p', 60 * 60 * 1000),
+)
+EPOCH = datetime(1970, 1, 1)
+
+DEFAULT_MAX_CONCURRENCY = 8
+DEFAULT_MAX_RETRIES = 5
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 60
+
+ROLLUP_RE = re.compile(r'\.rollup\(\s*\w+\s*,\s*(\d+)\s*\)')
 
 
 def get_month_int(month_string):
@@ -28,32 +86,48 @@ def adjust_datetime_to_utc(value, from_tz):
 
 def get_config(path):
     with open(path, 'r') as f:
-        return yaml.load(f)
+        return yaml.safe_load(f)
 
 
 def init_datadog(config):
-    initialize(**config['datadog'])
+    # the raw response gives ``api_call`` access to the rate limit headers and with
+    # mute off failures are raised rather than returned as an ``errors`` body
+    initialize(**dict(config['datadog'], return_raw_response=True, mute=False))
+
 
+@functools.lru_cache(maxsize=SCOPE_CACHE_SIZE)
+def _get_scope_values(scope_string, tags):
+    """The values of ``tags`` in a series scope e.g. ('web0', '/opt/data') for
+    'device:/opt/data,host:web0' and ('host', 'device'). The same scopes come
+    back for every window of a query so they are cached and the values interned."""
+    scope = {}
+    for tag in scope_string.split(','):
+        split = tag.split(':')
+        scope[split[0]] = split[-1]  # device:100.71.188.44:/opt/shared_icds
+    return tuple([sys.intern(scope[tag]) for tag in tags])
+
+
+def get_pointlist_by_host(query_result, tags=None, as_store=False):
+    """Group the pointlists in a query result by the values of ``tags``.
+
+    Returns nested dicts with one level per tag or, if ``as_store`` is set,
+    a ``series.SeriesStore`` keyed by tuples of the tag values.
+    """
+    tags = tuple(tags or ['host'])
+    if as_store:
+        return SeriesStore.from_pointlists(
+            (_get_scope_values(by_host['scope'], tags), by_host['pointlist']) for by_host in query_result['series']
+        )
 
-def get_pointlist_by_host(query_result, tags=None):
-    tags = tags or ['host']
     pointlist_by_host = defaultdict(dict)
     for by_host in query_result['series']:
-        scope = {}
-        for tag in by_host['scope'].split(','):
-            split = tag.split(':')
-            if len(split) > 2:  # device:100.71.188.44:/opt/shared_icds
-                scope[split[0]] = split[-1]
-            else:
-                scope[split[0]] = split[1]
-        pointlist = by_host['pointlist']
+        values = _get_scope_values(by_host['scope'], tags)
         context = pointlist_by_host
-        for tag in tags[:-1]:
-            key = scope[tag]
+        for key in values[:-1]:
             if key not in context:
                 context[key] = {}
             context = context[key]
-        context[scope[tags[-1]]] = pointlist
+        context[values[-1]] = by_host['pointlist']
     return pointlist_by_host
 
 
@@ -65,3 +139,868 @@ def arg_date_type(value):
             "Invalid date specified: '%s'. "
             "Expected date in the format: YYYY-MM-DD" % value
         )
+
+
+def add_replay_args(parser):
+    """Add the arguments for recording and replaying API requests"""
+    parser.add_argument('--record', metavar='DIR', help='Record all API responses to this directory.')
+    parser.add_argument(
+        '--replay', metavar='DIR',
+        help='Serve API responses from recordings in this directory instead of querying datadog.'
+    )
+    parser.add_argument(
+        '--replay-latency', type=float, default=0,
+        help='Artificial latency (in seconds) to add to each replayed response.'
+    )
+    parser.add_argument(
+        '--synthetic', type=int, metavar='HOSTS',
+        help='Serve generated data for a fleet of this many hosts instead of querying datadog.'
+    )
+    parser.add_argument('--synthetic-devices', type=int, default=4, help='Number of disks per synthetic host.')
+    parser.add_argument(
+        '--synthetic-resolution', type=int, default=60,
+        help='Resolution (in seconds) of synthetic data for queries without a rollup.'
+    )
+
+
+def configure_replay(args):
+    global _replay_store
+    if args.synthetic:
+        from synthetic import SyntheticApi, SyntheticFleet
+        fleet = SyntheticFleet(args.synthetic, args.synthetic_devices, args.synthetic_resolution)
+        _replay_store = SyntheticApi(fleet, latency=args.replay_latency)
+    elif args.replay:
+        _replay_store = ReplayStore(args.replay, replaying=True, latency=args.replay_latency)
+    elif args.record:
+        _replay_store = ReplayStore(args.record)
+    else:
+        _replay_store = None
+
+
+def add_query_args(parser):
+    """Add the arguments that control how metric queries are made"""
+    add_replay_args(parser)
+    parser.add_argument('--no-cache', action='store_true', help='Do not read or write the query cache.')
+    parser.add_argument('--refresh', action='store_true', help='Ignore cached results but store the fresh ones.')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help='Directory for the query cache.')
+    parser.add_argument(
+        '--cache-size', type=int, default=DEFAULT_CACHE_MAX_BYTES // 1024 ** 2,
+        help='Maximum size of the query cache in MB.'
+    )
+    parser.add_argument(
+        '--workers', type=int, default=DEFAULT_WORKERS,
+        help='Number of queries to run concurrently when fetching a range in chunks.'
+    )
+    parser.add_argument(
+        '--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+        help='Maximum number of expressions to combine into a single query.'
+    )
+    parser.add_argument(
+        '--max-concurrency', type=int, default=DEFAULT_MAX_CONCURRENCY,
+        help='Maximum number of API requests in flight at once.'
+    )
+    parser.add_argument(
+        '--max-retries', type=int, default=DEFAULT_MAX_RETRIES,
+        help='How many times to retry rate limited or failed API requests.'
+    )
+
+
+def add_source_args(parser):
+    """Add the arguments for answering queries from the local warehouse, see ``warehouse.py``"""
+    parser.add_argument(
+        '--source', choices=('datadog', 'local'), default='datadog',
+        help='Query datadog or answer from the local warehouse filled by "warehouse.py sync".'
+    )
+    parser.add_argument('--warehouse-dir', default=DEFAULT_WAREHOUSE_DIR, help='Directory of the local warehouse.')
+
+
+def configure_source(args):
+    global _warehouse
+    if getattr(args, 'source', 'datadog') == 'local':
+        from warehouse import Warehouse
+        _warehouse = Warehouse(args.warehouse_dir)
+    else:
+        _warehouse = None
+
+
+def configure_queries(args):
+    global _query_cache, _query_workers, _query_batch_size, _scheduler
+    configure_replay(args)
+    configure_source(args)
+    _query_workers = max(1, args.workers)
+    _query_batch_size = max(1, args.batch_size)
+    _scheduler = RequestScheduler(max(1, args.max_concurrency), max(0, args.max_retries))
+    # never mix generated or replayed responses into the real cache
+    if args.no_cache or args.synthetic or args.replay:
+        _query_cache = None
+    else:
+        # when recording every request has to reach ``api_call`` to be recorded
+        refresh = args.refresh or bool(args.record)
+        _query_cache = QueryCache(args.cache_dir, args.cache_size * 1024 ** 2, refresh=refresh)
+
+
+def normalize_query(query):
+    return re.sub(r'\s+', ' ', query).strip()
+
+
+def split_queries(query):
+    """Split a multi-query on the commas that aren't inside braces or brackets"""
+    queries = []
+    depth = 0
+    current = []
+    for char in query:
+        if char in '({':
+            depth += 1
+        elif char in ')}':
+            depth -= 1
+        if char == ',' and depth == 0:
+            queries.append(''.join(current).strip())
+            current = []
+        else:
+            current.append(char)
+    queries.append(''.join(current).strip())
+    return [query for query in queries if query]
+
+
+def _to_datetime(value):
+    if isinstance(value, datetime):
+        return value
+    return datetime(value.year, value.month, value.day)
+
+
+def _to_epoch(value):
+    """Epoch seconds for a UTC datetime or date, or anything ``int`` accepts"""
+    if isinstance(value, datetime):
+        return calendar.timegm(value.utctimetuple())
+    if isinstance(value, date):
+        return calendar.timegm(value.timetuple())
+    return int(value)
+
+
+class QueryCache(object):
+    """On disk cache of ``Metric.query`` responses.
+
+    Responses are stored one per file, keyed by the normalized query and the
+    time window. Windows that ended in the past never change and are kept until
+    evicted. Windows that are still open expire after ``CACHE_OPEN_WINDOW_TTL``.
+    When the cache grows beyond ``max_bytes`` the least recently used entries are removed.
+    The size of the cache is tracked as entries are written, so the directory is only
+    listed on the first write and when eviction is due.
+    """
+    def __init__(self, path, max_bytes=DEFAULT_CACHE_MAX_BYTES, refresh=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        self.total_bytes = None
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _get_path(self, query, start, end):
+        key = '{}|{}|{}'.format(normalize_query(query), start, end)
+        return os.path.join(self.path, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, query, start, end):
+        if self.refresh:
+            return None
+        path = self._get_path(query, start, end)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if entry['expires'] is not None and entry['expires'] < time.time():
+            return None
+        try:
+            os.utime(path, None)  # mark as recently used
+        except OSError:
+            pass
+        return entry['response']
+
+    def set(self, query, start, end, response):
+        now = time.time()
+        expires = None if end <= now - CACHE_SETTLE_SECONDS else now + CACHE_OPEN_WINDOW_TTL
+        path = self._get_path(query, start, end)
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'query': normalize_query(query),
+                'start': start,
+                'end': end,
+                'expires': expires,
+                'response': response,
+            }, f)
+            size = f.tell()
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        os.rename(tmp_path, path)
+
+        with self.lock:
+            if self.total_bytes is None:
+                self._evict()
+            else:
+                self.total_bytes += size - replaced
+                if self.total_bytes > self.max_bytes:
+                    self._evict()
+
+    def _evict(self):
+        """Remove the least recently used entries until the cache is well within ``max_bytes``.
+        This also resets the tracked size, which other processes sharing the cache can skew."""
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if not name.endswith('.json'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+            total += stat.st_size
+
+        entries.sort()
+        for _, size, name in entries:
+            if total <= self.max_bytes * CACHE_EVICT_TO:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
+        self.total_bytes = total
+
+
+class RateLimiter(object):
+    """Token bucket that is kept in sync with the ``X-RateLimit-*`` headers
+    returned by datadog. Until the first headers are seen requests are not paced."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rate = None
+        self.capacity = None
+        self.tokens = None
+        self.updated = None
+        self.reset_at = None
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                wait = self._take()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def _take(self):
+        """Take a token if one is available, otherwise return how long to wait for one"""
+        if self.rate is None:
+            return 0
+        now = time.time()
+        if self.reset_at is not None and now >= self.reset_at:
+            self.tokens = self.capacity
+            self.reset_at = None
+        else:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        wait = (1 - self.tokens) / self.rate
+        if self.reset_at is not None:
+            wait = min(wait, self.reset_at - now)
+        return max(wait, 0.01)
+
+    def update(self, headers):
+        try:
+            limit = int(headers['X-RateLimit-Limit'])
+            remaining = int(headers['X-RateLimit-Remaining'])
+            reset = int(headers['X-RateLimit-Reset'])
+            period = int(headers.get('X-RateLimit-Period') or reset or 1)
+        except (KeyError, TypeError, ValueError):
+            return
+        with self.lock:
+            now = time.time()
+            self.capacity = max(limit, 1)
+            self.rate = float(self.capacity) / max(period, 1)
+            self.tokens = remaining
+            self.updated = now
+            self.reset_at = now + reset
+
+    def block_until_reset(self, default_wait):
+        """Stop handing out tokens after being rate limited"""
+        with self.lock:
+            now = time.time()
+            self.tokens = 0
+            self.updated = now
+            if self.reset_at is None or self.reset_at <= now:
+                self.reset_at = now + default_wait
+            if self.rate is None:
+                self.rate = 1.0 / default_wait
+                self.capacity = 1
+            return self.reset_at - now
+
+
+class RateLimited(Exception):
+    pass
+
+
+class Unreachable(Exception):
+    """A connection failure that a muted datadog client returned as an ``errors`` body"""
+
+
+class RequestScheduler(object):
+    """Central place that every datadog API request goes through.
+
+    Caps the number of requests in flight, paces requests to stay within the
+    rate limits reported by datadog and retries rate limited requests and
+    transient failures with jittered exponential backoff.
+    """
+    transient_errors = (
+        ClientError, HttpBackoff, HttpTimeout, HTTPError, RateLimited, Unreachable,
+        requests.ConnectionError, requests.Timeout,
+    )
+
+    def __init__(self, max_concurrency=DEFAULT_MAX_CONCURRENCY, max_retries=DEFAULT_MAX_RETRIES):
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.max_retries = max_retries
+        self.limiter = RateLimiter()
+
+    def call(self, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            try:
+                with self.semaphore:
+                    try:
+                        response = func(*args, **kwargs)
+                    except ApiError as e:
+                        # an unmuted client raises error bodies, including 429s
+                        response = e.args[0]
+                return self._unwrap(response)
+            except self.transient_errors as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._get_delay(attempt, e)
+                logging.warning('API request failed (%s), retrying in %.1fs', e, delay)
+                time.sleep(delay)
+                attempt += 1
+
+    def _get_delay(self, attempt, error):
+        backoff = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+        if isinstance(error, RateLimited):
+            return max(backoff, self.limiter.block_until_reset(RETRY_MAX_DELAY))
+        if isinstance(error, HttpBackoff):
+            return max(backoff, error.args[0] if error.args else 0)
+        return backoff
+
+    def _unwrap(self, response):
+        http_response = None
+        if isinstance(response, tuple):  # datadog client with return_raw_response
+            response, http_response = response
+        elif isinstance(response, requests.Response):
+            http_response = response
+
+        if http_response is not None:
+            self.limiter.update(http_response.headers)
+            if http_response.status_code == 429:
+                raise RateLimited('HTTP 429')
+            if http_response.status_code >= 500:
+                raise HTTPError(http_response.status_code, http_response.reason)
+
+        if isinstance(response, dict) and response.get('errors'):
+            raise _classify_errors(response)
+        return response
+
+
+def _classify_errors(response):
+    """The exception for an ``errors`` body. A muted client returns the body of a 429
+    and the message of a ``ClientError`` this way, without the raw response."""
+    errors = response['errors']
+    if not isinstance(errors, list):
+        errors = [errors]
+    messages = [str(error).lower() for error in errors]
+    if any('rate limit' in message for message in messages):
+        return RateLimited(response['errors'])
+    if any(message.startswith('could not request') for message in messages):
+        return Unreachable(response['errors'])
+    return ApiError(response)
+
+
+_scheduler = RequestScheduler()
+_replay_store = None
+
+
+def api_call(func, *args, **kwargs):
+    """Make a datadog API request through the request scheduler e.g.
+
+        api_call(api.Dashboard.get, dashboard_id)
+
+    When replaying (see ``configure_replay``) the response comes from the recordings instead.
+    """
+    if _replay_store and _replay_store.replaying:
+        return _scheduler.call(_replay_store.replay, func, args, kwargs)
+
+    response = _scheduler.call(func, *args, **kwargs)
+    if _replay_store:
+        response = _replay_store.record(func, args, kwargs, response)
+    return response
+
+
+_query_cache = None
+_warehouse = None
+_query_workers = DEFAULT_WORKERS
+_query_batch_size = DEFAULT_BATCH_SIZE
+
+
+def _get_cached(query, start, end):
+    if _query_cache:
+        return _query_cache.get(query, start, end)
+
+
+def _set_cached(query, start, end, response):
+    if _query_cache and 'errors' not in response and response.get('status', 'ok') == 'ok':
+        _query_cache.set(query, start, end, response)
+
+
+def query_metric(query, start, end):
+    """Wrapper for ``api.Metric.query`` which all scripts should use.
+
+    Call ``configure_queries`` first to enable caching or to answer from the local warehouse.
+    """
+    start, end = _to_epoch(start), _to_epoch(end)
+    if _warehouse:
+        return _warehouse.query(query, start, end)
+    cached = _get_cached(query, start, end)
+    if cached is not None:
+        return cached
+
+    response = api_call(api.Metric.query, start=start, end=end, query=query)
+    _set_cached(query, start, end, response)
+    return response
+
+
+def _split_batch_response(queries, response):
+    """Split the response of a multi-query into one response per query, or return
+    None if some of the series can't be told apart.
+
+    Each query may itself be a comma separated list so it owns one ``query_index``
+    per expression. Series without a ``query_index`` are matched on their expression,
+    failing that by position when there is exactly one series per expression."""
+    if len(queries) == 1:
+        return [response]
+    owners, expressions = [], []
+    for position, query in enumerate(queries):
+        for expression in split_queries(query):
+            owners.append(position)
+            expressions.append(normalize_query(expression).replace(' ', ''))
+
+    series_list = response.get('series', [])
+    by_query = [[] for _ in queries]
+    for position, series in enumerate(series_list):
+        index = series.get('query_index')
+        if index is None:
+            expression = normalize_query(series.get('expression', '')).replace(' ', '')
+            if expression in expressions:
+                index = expressions.index(expression)
+            elif len(series_list) == len(expressions):
+                index = position
+            else:
+                return None
+        by_query[owners[index]].append(series)
+    return [dict(response, series=series) for series in by_query]
+
+
+def query_batch(queries, start, end, batch_size=None):
+    """Run many queries over the same window using as few requests as possible.
+
+    Queries are combined into comma separated multi-queries of up to ``batch_size``
+    queries and the returned series are split back out by their ``query_index``, see
+    ``_split_batch_response``. If a response can't be split the queries of that batch
+    are sent one at a time. Returns one result per query, in order.
+    """
+    start, end = _to_epoch(start), _to_epoch(end)
+    if _warehouse:
+        return [_warehouse.query(query, start, end) for query in queries]
+    batch_size = batch_size or _query_batch_size
+    results = [_get_cached(query, start, end) for query in queries]
+    missing = [i for i, result in enumerate(results) if result is None]
+    batches = [missing[i:i + batch_size] for i in range(0, len(missing), batch_size)]
+
+    def _fetch(batch):
+        batch_queries = [queries[i] for i in batch]
+        response = api_call(api.Metric.query, start=start, end=end, query=','.join(batch_queries))
+        if 'errors' in response:
+            return [response] * len(batch)
+        split = _split_batch_response(batch_queries, response)
+        if split is None:
+            logging.warning('Unable to split a batch of %d queries, sending them one at a time', len(batch))
+            split = [api_call(api.Metric.query, start=start, end=end, query=query) for query in batch_queries]
+        return split
+
+    with ThreadPoolExecutor(max_workers=_query_workers) as executor:
+        for batch, batch_results in zip(batches, executor.map(_fetch, batches)):
+            for i, result in zip(batch, batch_results):
+                _set_cached(queries[i], start, end, result)
+                results[i] = result
+    return results
+
+
+def day_windows(start, end, days=1):
+    """Split ``start`` -> ``end`` into consecutive windows of ``days`` days.
+    The last window may extend past ``end``."""
+    windows = []
+    while start < end:
+        windows.append((start, start + timedelta(days=days)))
+        start += timedelta(days=days)
+    return windows
+
+
+def iter_query_windows(query, windows, workers=None):
+    """Run ``query`` for each ``(start, end)`` window using a pool of worker threads.
+
+    Yields ``(window, result)`` tuples in the same order as ``windows``
+    regardless of the order in which the queries complete. At most ``workers``
+    queries are in flight, so results aren't held for windows the caller hasn't reached.
+    """
+    workers = workers or _query_workers
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending = deque()
+    try:
+        for window in windows:
+            if len(pending) >= workers:
+                done_window, future = pending.popleft()
+                yield done_window, future.result()
+            pending.append((window, executor.submit(query_metric, query, window[0], window[1])))
+        while pending:
+            done_window, future = pending.popleft()
+            yield done_window, future.result()
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def get_rollup_interval(query):
+    """Smallest rollup interval (in seconds) used in ``query`` or None if there is no explicit rollup"""
+    intervals = [int(interval) for interval in ROLLUP_RE.findall(query)]
+    return min(intervals) if intervals else None
+
+
+def plan_query_windows(query, start, end, rollup=None, max_points=MAX_QUERY_POINTS):
+    """Split ``start`` -> ``end`` into the fewest windows that each return at most
+    ``max_points`` points per series at the given rollup interval.
+
+    ``rollup`` defaults to the interval given in the query. Without a rollup
+    the number of points can't be predicted so the range is split into days.
+    """
+    rollup = rollup or get_rollup_interval(query)
+    start, end = _to_datetime(start), _to_datetime(end)
+    if not rollup:
+        return [(window_start, min(window_end, end)) for window_start, window_end in day_windows(start, end)]
+
+    span = timedelta(seconds=rollup * max_points)
+    windows = []
+    while start < end:
+        windows.append((start, min(start + span, end)))
+        start += span
+    return windows
+
+
+def get_result_interval(result):
+    """Interval (in seconds) of the points returned by a query"""
+    for series in result.get('series', []):
+        if series.get('interval'):
+            return int(series['interval'])
+        pointlist = series.get('pointlist', [])
+        if len(pointlist) > 1:
+            return int((pointlist[1][0] - pointlist[0][0]) / 1000)
+    return None
+
+
+def _iter_checked_windows(query, windows, rollup):
+    for window, result in iter_query_windows(query, windows):
+        interval = get_result_interval(result)
+        if rollup and interval and interval != rollup:
+            start, end = window
+            half = int((end - start).total_seconds() // 2 // rollup) * rollup
+            if interval > rollup and half:
+                # datadog downsampled the data, try again with smaller windows
+                middle = start + timedelta(seconds=half)
+                for sub_window, sub_result in _iter_checked_windows(query, [(start, middle), (middle, end)], rollup):
+                    yield sub_window, sub_result
+                continue
+            print('[WARNING] data interval different from requested: {} != {}'.format(interval, rollup))
+        yield window, result
+
+
+def iter_query_range(query, start, end, rollup=None):
+    """Query ``start`` -> ``end`` in as few requests as possible.
+
+    Yields ``(window, result)`` tuples in time order. Windows where datadog
+    returned data at a coarser interval than requested are split and refetched.
+    """
+    rollup = rollup or get_rollup_interval(query)
+    windows = plan_query_windows(query, start, end, rollup)
+    return _iter_checked_windows(query, windows, rollup)
+
+
+def merge_query_results(results):
+    """Join the results of the same query over consecutive windows into a single result"""
+    merged = None
+    series_by_key = {}
+    for result in results:
+        if merged is None:
+            merged = dict(result, series=[])
+        for series in result.get('series', []):
+            key = (series.get('query_index'), series.get('expression'), series.get('scope'))
+            if key not in series_by_key:
+                series_by_key[key] = dict(series, pointlist=[])
+                merged['series'].append(series_by_key[key])
+            pointlist = series_by_key[key]['pointlist']
+            for point in series['pointlist']:
+                # windows share their boundaries so the same point may be returned twice
+                if not pointlist or point[0] > pointlist[-1][0]:
+                    pointlist.append(point)
+
+    for series in series_by_key.values():
+        series['length'] = len(series['pointlist'])
+    return merged or {'series': []}
+
+
+def query_range(query, start, end, rollup=None):
+    """Like ``query_metric`` but split into as many requests as needed to get
+    every point at the requested rollup"""
+    if _warehouse:
+        return _warehouse.query(query, _to_epoch(start), _to_epoch(end))
+    return merge_query_results(result for _, result in iter_query_range(query, start, end, rollup))
+
+
+def add_join_args(parser):
+    """Add the arguments that control how the series in a result are joined into rows"""
+    parser.add_argument(
+        '--join', choices=('outer', 'inner'), default='outer',
+        help='Print a row for every timestamp in any series (outer) or only those in all of them (inner).'
+    )
+    parser.add_argument('--fill', type=float, help='Value for timestamps missing from a series instead of "---".')
+
+
+def join_result(query_result, how='outer', fill=None):
+    """Join the series of a query result on their timestamps into a ``series.Table``
+    with a column per series in the order they were returned"""
+    return Table.join(
+        [Series.from_pointlist(item.get('pointlist', [])) for item in query_result['series']], how=how, fill=fill
+    )
+
+
+def window_edges(windows):
+    """Epoch ms boundaries of consecutive ``(start, end)`` windows, e.g. to pass to ``series.Series.split``"""
+    return [_to_epoch(start) * 1000 for start, _ in windows] + [_to_epoch(windows[-1][1]) * 1000]
+
+
+def _local_midnight(day, timezone):
+    """Epoch ms of the start of ``day`` in ``timezone``"""
+    midnight = timezone.localize(datetime(day.year, day.month, day.day))
+    return calendar.timegm(midnight.utctimetuple()) * 1000
+
+
+_transitions_by_zone = {}
+
+
+def _get_transitions(timezone):
+    """Epoch ms of each change in the UTC offset of a pytz ``timezone`` and the offsets
+    in ms in effect before the first and after each change"""
+    zone = str(timezone)
+    if zone not in _transitions_by_zone:
+        # pytz keeps the zone's transition table, fixed offset zones don't have one
+        times = getattr(timezone, '_utc_transition_times', None)
+        if times:
+            edges = np.array([calendar.timegm(time.utctimetuple()) * 1000 for time in times[1:]], dtype=np.int64)
+            offsets = np.array([info[0].total_seconds() * 1000 for info in timezone._transition_info], dtype=np.int64)
+        else:
+            edges = np.zeros(0, dtype=np.int64)
+            offsets = np.array([timezone.utcoffset(EPOCH).total_seconds() * 1000], dtype=np.int64)
+        _transitions_by_zone[zone] = (edges, offsets)
+    return _transitions_by_zone[zone]
+
+
+def get_utc_offsets(timestamps, timezone):
+    """The UTC offset in ms of ``timezone`` at each of an array of epoch ms ``timestamps``"""
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    if not len(timestamps):
+        return np.zeros(0, dtype=np.int64)
+    edges, offsets = _get_transitions(timezone)
+    # only the transitions within the range of the timestamps are searched
+    first = np.searchsorted(edges, timestamps.min(), side='right')
+    last = np.searchsorted(edges, timestamps.max(), side='right')
+    return offsets[first:last + 1][np.searchsorted(edges[first:last], timestamps, side='right')]
+
+
+def format_epochs(timestamps, timezone, format='%Y-%m-%d'):
+    """Format epoch ms ``timestamps`` as local times in ``timezone``, like
+    ``icds_success.format_epoch`` for many points at once. The timestamps are
+    converted together and each distinct local day, hour, minute etc. (whatever
+    the finest unit in ``format`` is) is only formatted once."""
+    timestamps = np.asarray(timestamps, dtype=np.float64).astype(np.int64)
+    resolution = min(
+        [ms for directive, ms in FORMAT_RESOLUTION_MS if directive in format] or [DAY_SECONDS * 1000]
+    )
+    local = timestamps + get_utc_offsets(timestamps, timezone)
+    buckets, positions = np.unique(local // resolution, return_inverse=True)
+    formatted = np.array([
+        (EPOCH + timedelta(milliseconds=int(bucket) * resolution)).strftime(format) for bucket in buckets
+    ], dtype=object)
+    return formatted[positions.reshape(-1)].tolist()
+
+
+def local_rollup_edges(first, last, interval, timezone):
+    """Epoch ms edges of ``interval`` second buckets covering ``first`` -> ``last`` (epoch ms)
+    aligned to midnight in ``timezone``. Buckets are restarted at each local midnight
+    so they stay aligned when the UTC offset changes."""
+    day = pytz.utc.localize(datetime.utcfromtimestamp(first / 1000)).astimezone(timezone).date()
+    days = max(1, interval // DAY_SECONDS)
+    midnight = _local_midnight(day, timezone)
+    edges = []
+    while midnight <= last:
+        day += timedelta(days=days)
+        next_midnight = _local_midnight(day, timezone)
+        edges.extend(range(midnight, next_midnight, interval * 1000) if interval < DAY_SECONDS else [midnight])
+        midnight = next_midnight
+    edges.append(midnight)
+    return edges
+
+
+def local_rollup(series, interval, timezone, how='sum'):
+    """Roll a ``series.Series`` up to ``interval`` seconds aligned to midnight in ``timezone``"""
+    if not len(series):
+        return series
+    edges = local_rollup_edges(int(series.timestamps[0]), int(series.timestamps[-1]), interval, timezone)
+    return series.split(edges).to_series(how)
+
+
+def get_base_interval(intervals, timezone, when):
+    """The interval to fetch so that each of ``intervals`` can be rolled up from it
+    locally: the finest of them, made finer if needed to line up with the UTC offset
+    of ``timezone`` e.g. 30 minutes for hourly data in India"""
+    base = min(intervals)
+    offset = abs(int(timezone.utcoffset(when).total_seconds()))
+    return math.gcd(base, offset) if offset % base else base
+
+
+def query_local_rollups(template, start, end, intervals, timezone, how='sum', **context):
+    """Fetch ``template`` (formatted with ``context`` and the ``rollup`` interval)
+    once at the base interval and roll it up locally to each of ``intervals``.
+    Returns a dict of interval to a result shaped like a query response."""
+    base = get_base_interval(intervals, timezone, start)
+    result = query_range(template.format(rollup=base, **context), start, end, rollup=base)
+    rollups = {}
+    for interval in intervals:
+        series = []
+        for item in result['series']:
+            rolled = local_rollup(Series.from_pointlist(item['pointlist']), interval, timezone, how)
+            series.append(dict(item, pointlist=rolled.to_pointlist(), interval=interval, length=len(rolled)))
+        rollups[interval] = dict(result, series=series)
+    return rollups
+
+
+def split_pointlist(pointlist, windows):
+    """Split a time ordered pointlist into a list of points for each ``(start, end)`` window"""
+    bounds = [(_to_epoch(start) * 1000, _to_epoch(end) * 1000) for start, end in windows]
+    split = [[] for _ in windows]
+    index = 0
+    for point in pointlist:
+        while index < len(bounds) and point[0] >= bounds[index][1]:
+            index += 1
+        if index == len(bounds):
+            break
+        if point[0] >= bounds[index][0]:
+            split[index].append(point)
+    return split
+
+
+class _JsonStream(object):
+    """Text buffer over an iterable of chunks of a JSON document that only
+    keeps the part that hasn't been decoded yet"""
+    whitespace = ' \t\n\r'
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.exhausted = False
+
+    def _fill(self):
+        """Read the next chunk into the buffer. Returns False at the end of the document."""
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        for chunk in self.chunks:
+            text = self.utf8.decode(chunk) if isinstance(chunk, bytes) else chunk
+            if text:
+                self.buffer += text
+                return True
+        self.exhausted = True
+        return False
+
+    def peek(self):
+        """Skip whitespace and return the next character"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in self.whitespace:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise ValueError('Unexpected end of JSON document')
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('Expected {!r} but found {!r}'.format(char, self.buffer[self.pos:self.pos + 20]))
+        self.pos += 1
+
+    def decode(self):
+        """Decode the next complete value"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if self.exhausted or not self._fill():
+                    raise
+                continue
+            # a number at the end of the buffer may continue in the next chunk
+            if end == len(self.buffer) and not self.exhausted and self._fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_json_items(chunks, key):
+    """Yield the items of the list under ``key`` in a JSON object one at a time
+    as the document is read from ``chunks`` e.g. ``response.iter_content()``
+    so that large responses never have to be held in memory all at once."""
+    stream = _JsonStream(chunks)
+    stream.expect('{')
+    if stream.peek() == '}':
+        return
+    while True:
+        name = stream.decode()
+        stream.expect(':')
+        if name != key:
+            stream.decode()
+        else:
+            stream.expect('[')
+            if stream.peek() == ']':
+                stream.pos += 1
+            else:
+                while True:
+                    yield stream.decode()
+                    if stream.peek() != ',':
+                        stream.expect(']')
+                        break
+                    stream.pos += 1
+
+        if stream.peek() != ',':
+            stream.expect('}')
+            return
+        stream.pos += 1
@@ -0,0 +1,300 @@
+# Local warehouse of metric data for reports over history that doesn't change.
+#
+# The points of each query expression are stored one UTC day at a time in a
+# SQLite database with the timestamps and values of each series as packed
+# arrays. Syncing only fetches the days that aren't stored yet:
+#
+#     python scripts/warehouse.py sync -e icds -s 2018-01-01
+#
+# and the reports answer from the warehouse instead of datadog with ``--source local``:
+#
+#     python scripts/total_data_size.py -e icds -s Jan -f Dec --source local
+from __future__ import print_function
+
+import argparse
+import calendar
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from itertools import groupby
+
+import numpy as np
+
+import request_success
+import requests_per_month
+import total_data_size
+from const import ENV_TZ
+from series import Series
+from utils import CACHE_SETTLE_SECONDS, DAY_SECONDS, DEFAULT_WAREHOUSE_DIR
+from utils import add_query_args, arg_date_type, configure_queries, get_config, init_datadog
+from utils import get_base_interval, get_rollup_interval, iter_query_range, merge_query_results
+from utils import normalize_query, split_queries
+
+ROLLUP_RE = re.compile(r'\.rollup\(\s*(\w+)\s*,\s*(\d+)\s*\)')
+# how daily rollups are rolled up further for each datadog rollup method
+ROLLUP_METHODS = {'avg': 'mean', 'sum': 'sum', 'max': 'max', 'min': 'min'}
+
+# days fetched per request range so an interrupted sync keeps most of its progress
+SYNC_CHUNK_DAYS = 31
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS series ('
+    ' id INTEGER PRIMARY KEY, expression TEXT NOT NULL, scope TEXT NOT NULL, meta TEXT NOT NULL,'
+    ' UNIQUE (expression, scope))',
+    'CREATE TABLE IF NOT EXISTS points ('
+    ' series_id INTEGER NOT NULL, day INTEGER NOT NULL, timestamps BLOB NOT NULL, vals BLOB NOT NULL,'
+    ' PRIMARY KEY (series_id, day))',
+    'CREATE TABLE IF NOT EXISTS days (expression TEXT NOT NULL, day INTEGER NOT NULL, PRIMARY KEY (expression, day))',
+)
+
+
+class WarehouseMissing(Exception):
+    pass
+
+
+def get_stored_expression(expression):
+    """How ``expression`` is stored: normalized and with rollups longer than a day
+    made daily. Returns ``(stored, interval, how)`` where ``interval`` (seconds)
+    and ``how`` roll the stored data back up or are None if it is stored as is."""
+    expression = normalize_query(expression)
+    rollups = set(ROLLUP_RE.findall(expression))
+    longer = [(method, int(interval)) for method, interval in rollups if int(interval) > DAY_SECONDS]
+    if not longer:
+        return expression, None, None
+    method, interval = longer[0]
+    if len(rollups) > 1 or method not in ROLLUP_METHODS:
+        raise ValueError('Unable to store the rollups of {}'.format(expression))
+    stored = ROLLUP_RE.sub('.rollup({}, {})'.format(method, DAY_SECONDS), expression)
+    return stored, interval, ROLLUP_METHODS[method]
+
+
+def get_days(start, end):
+    """The UTC days (since the epoch) that ``start`` -> ``end`` (epoch seconds) covers.
+    ``end`` is exclusive, so an ``end`` at midnight doesn't add the day it starts."""
+    return range(start // DAY_SECONDS, max(start, end - 1) // DAY_SECONDS + 1)
+
+
+def format_day(day):
+    return str(date(1970, 1, 1) + timedelta(days=day))
+
+
+class Warehouse(object):
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        # queries may be answered from several threads, see utils.iter_query_windows
+        self.db = sqlite3.connect(os.path.join(path, 'warehouse.sqlite3'), check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            for statement in SCHEMA:
+                self.db.execute(statement)
+
+    def get_stored_days(self, expression):
+        with self.lock:
+            rows = self.db.execute('SELECT day FROM days WHERE expression = ?', (expression,)).fetchall()
+        return {day for day, in rows}
+
+    def _get_series_id(self, expression, item):
+        scope = item.get('scope', '')
+        meta = {key: value for key, value in item.items() if key not in ('pointlist', 'length', 'start', 'end', 'query_index')}
+        self.db.execute(
+            'INSERT OR IGNORE INTO series (expression, scope, meta) VALUES (?, ?, ?)',
+            (expression, scope, json.dumps(meta))
+        )
+        return self.db.execute(
+            'SELECT id FROM series WHERE expression = ? AND scope = ?', (expression, scope)
+        ).fetchone()[0]
+
+    def store(self, expression, first_day, last_day, result):
+        """Store the series of a query result for ``expression`` and mark the days
+        from ``first_day`` to ``last_day`` as stored. Points outside those days are dropped."""
+        edges = [day * DAY_SECONDS * 1000 for day in range(first_day, last_day + 2)]
+        with self.lock, self.db:
+            for item in result.get('series', []):
+                series_id = self._get_series_id(expression, item)
+                by_day = Series.from_pointlist(item['pointlist']).split(edges)
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO points (series_id, day, timestamps, vals) VALUES (?, ?, ?, ?)',
+                    [
+                        (series_id, day_start // (DAY_SECONDS * 1000), points.timestamps.tobytes(), points.values.tobytes())
+                        for day_start, points in by_day.items() if len(points)
+                    ]
+                )
+            self.db.executemany(
+                'INSERT OR REPLACE INTO days (expression, day) VALUES (?, ?)',
+                [(expression, day) for day in range(first_day, last_day + 1)]
+            )
+
+    def _read(self, expression, start, end):
+        """``(meta, Series)`` for each stored series of ``expression`` from ``start`` to ``end`` (epoch seconds),
+        including the points at ``end`` if its day is stored"""
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT series.id, series.meta, points.timestamps, points.vals FROM series'
+                ' JOIN points ON points.series_id = series.id'
+                ' WHERE series.expression = ? AND points.day BETWEEN ? AND ?'
+                ' ORDER BY series.id, points.day',
+                (expression, start // DAY_SECONDS, end // DAY_SECONDS)
+            ).fetchall()
+        for _, group in groupby(rows, key=lambda row: row[0]):
+            group = list(group)
+            timestamps = np.concatenate([np.frombuffer(row[2], dtype=np.int64) for row in group])
+            values = np.concatenate([np.frombuffer(row[3], dtype=np.float64) for row in group])
+            inside = (timestamps >= start * 1000) & (timestamps <= end * 1000)
+            yield json.loads(group[0][1]), Series(timestamps[inside], values[inside])
+
+    def query(self, query, start, end):
+        """Answer ``query`` from ``start`` to ``end`` (epoch seconds) with a result
+        shaped like a ``Metric.query`` response. Raises ``WarehouseMissing`` if any of
+        the days haven't been synced. Like datadog the result includes a point at
+        ``end``, but only if the day it starts has been synced too."""
+        series = []
+        for query_index, expression in enumerate(split_queries(query)):
+            stored, interval, how = get_stored_expression(expression)
+            # like datadog, start with the rollup bucket that contains ``start`` but never
+            # before its day so the days synced for a range are enough to answer it
+            rollup = get_rollup_interval(stored)
+            first = max(start // rollup * rollup, start // DAY_SECONDS * DAY_SECONDS) if rollup else start
+            missing = set(get_days(first, end)) - self.get_stored_days(stored)
+            if missing:
+                raise WarehouseMissing('{} days from {} to {} of "{}" are not stored, see "warehouse.py sync"'.format(
+                    len(missing), format_day(min(missing)), format_day(max(missing)), stored
+                ))
+            for meta, points in self._read(stored, first, end):
+                if interval:
+                    # like datadog, buckets are aligned to multiples of the interval since the epoch
+                    points = points.resample(interval * 1000, how)
+                    meta = dict(meta, interval=interval)
+                pointlist = points.to_pointlist()
+                series.append(dict(
+                    meta, query_index=query_index, pointlist=pointlist, length=len(pointlist),
+                    start=start * 1000, end=end * 1000,
+                ))
+        return {
+            'status': 'ok',
+            'res_type': 'time_series',
+            'query': query,
+            'from_date': start * 1000,
+            'to_date': end * 1000,
+            'series': series,
+        }
+
+    def get_status(self):
+        """``(expression, first day, last day, number of days)`` for each stored expression"""
+        with self.lock:
+            return self.db.execute(
+                'SELECT expression, MIN(day), MAX(day), COUNT(*) FROM days GROUP BY expression ORDER BY expression'
+            ).fetchall()
+
+
+def _get_runs(days):
+    """Split sorted days into ``(first, last)`` runs of consecutive days of at most ``SYNC_CHUNK_DAYS``"""
+    runs = []
+    for day in days:
+        if runs and day == runs[-1][1] + 1 and day - runs[-1][0] < SYNC_CHUNK_DAYS:
+            runs[-1][1] = day
+        else:
+            runs.append([day, day])
+    return [tuple(run) for run in runs]
+
+
+def _fetch(expression, first_day, last_day):
+    start = datetime.utcfromtimestamp(first_day * DAY_SECONDS)
+    end = datetime.utcfromtimestamp((last_day + 1) * DAY_SECONDS)
+    results = []
+    for _, result in iter_query_range(expression, start, end):
+        if 'errors' in result or result.get('status', 'ok') != 'ok':
+            raise Exception(result.get('errors', result))
+        results.append(result)
+    return merge_query_results(results)
+
+
+def sync(warehouse, queries, start, end):
+    """Fetch the days from ``start`` up to ``end`` (epoch seconds) of each expression in
+    ``queries`` that aren't stored yet. Days that ended less than ``CACHE_SETTLE_SECONDS``
+    ago may still change and aren't stored. Yields ``(expression, already stored, fetched)``
+    counts of days as each expression is done."""
+    last_settled = (int(time.time()) - CACHE_SETTLE_SECONDS) // DAY_SECONDS - 1
+    expressions = OrderedDict(
+        (get_stored_expression(expression)[0], None) for query in queries for expression in split_queries(query)
+    )
+    for expression in expressions:
+        if not get_rollup_interval(expression):
+            raise ValueError('Only queries with an explicit rollup can be stored: {}'.format(expression))
+        days = [day for day in get_days(start, end) if day <= last_settled]
+        missing = sorted(set(days) - warehouse.get_stored_days(expression))
+        for first_day, last_day in _get_runs(missing):
+            warehouse.store(expression, first_day, last_day, _fetch(expression, first_day, last_day))
+        yield expression, len(days) - len(missing), len(missing)
+
+
+def _get_request_success_queries(env):
+    # each interval and the finer one fetched when several are rolled up in the environment's timezone
+    rollups = set(request_success.INTERVALS.values())
+    rollups |= {
+        get_base_interval([rollup], ENV_TZ[env], datetime.utcnow()) for rollup in request_success.INTERVALS.values()
+    }
+    return [
+        template.format(env=env, rollup=rollup) for rollup in sorted(rollups) for _, template in request_success.METRICS
+    ]
+
+
+REPORTS = OrderedDict([
+    ('request_success', _get_request_success_queries),
+    ('total_data_size', lambda env: [total_data_size.get_query(env)]),
+    ('requests_per_month', lambda env: [requests_per_month.LOCAL_QUERY.format(env=env)]),
+])
+
+
+def _get_args():
+    parser = argparse.ArgumentParser(description='Keep a local warehouse of metric data for offline reports')
+    parser.add_argument('--warehouse-dir', default=DEFAULT_WAREHOUSE_DIR, help='Directory of the local warehouse.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    sync_parser = commands.add_parser('sync', help='Fetch the days that are not stored yet.')
+    sync_parser.add_argument('--config', default='config.yml', help='Path to config file.')
+    sync_parser.add_argument(
+        '-e', '--env', nargs='+', default=[], choices=ENV_TZ.keys(), help='Environments to sync the reports for.'
+    )
+    sync_parser.add_argument(
+        '-r', '--report', nargs='+', default=list(REPORTS), choices=list(REPORTS),
+        help='Reports to sync the queries of. Defaults to all.'
+    )
+    sync_parser.add_argument(
+        '-q', '--query', nargs='+', default=[], help='Other queries to sync, each with an explicit rollup.'
+    )
+    sync_parser.add_argument('-s', '--start-date', type=arg_date_type, required=True, help='First day to sync e.g. 2018-01-23')
+    sync_parser.add_argument(
+        '-f', '--end-date', type=arg_date_type, help='Last day to sync. Defaults to the last day that has ended.'
+    )
+    add_query_args(sync_parser)
+
+    commands.add_parser('status', help='List the stored expressions and the days they cover.')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = _get_args()
+    warehouse = Warehouse(args.warehouse_dir)
+
+    if args.command == 'status':
+        for expression, first_day, last_day, days in warehouse.get_status():
+            print('{} to {} ({} days): {}'.format(format_day(first_day), format_day(last_day), days, expression))
+
+    elif args.command == 'sync':
+        config = get_config(args.config)
+        init_datadog(config)
+        configure_queries(args)
+
+        queries = [query for env in args.env for report in args.report for query in REPORTS[report](env)] + args.query
+        start = calendar.timegm(args.start_date.timetuple())
+        end = calendar.timegm((args.end_date or datetime.utcnow().date()).timetuple()) + DAY_SECONDS
+        for expression, stored, fetched in sync(warehouse, queries, start, end):
+            print('{} days fetched, {} already stored: {}'.format(fetched, stored, expression))
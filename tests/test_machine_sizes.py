@@ -0,0 +1,28 @@
+from datetime import datetime
+
+import pytest
+
+import machine_sizes
+import utils
+from synthetic import SyntheticApi, SyntheticFleet
+
+
+@pytest.fixture
+def fleet(monkeypatch):
+    monkeypatch.setattr(utils, '_replay_store', SyntheticApi(SyntheticFleet(hosts=12)))
+    monkeypatch.setattr(utils, '_query_cache', None)
+    monkeypatch.setattr(machine_sizes, '_inventory_dir', None)
+    machine_sizes.get_host_stats.cache_clear()
+    yield
+    machine_sizes.get_host_stats.cache_clear()
+
+
+def test_fleet_usage_stats(fleet):
+    env_names = ['icds', 'swiss', 'production']
+    usage_by_env = machine_sizes.get_fleet_usage_stats(env_names, None, datetime(2020, 1, 8))
+    assert list(usage_by_env) == env_names
+    for env_name, usage_stats in usage_by_env.items():
+        assert len(usage_stats) == 12
+        assert all(stats.name.startswith(env_name + '-') for stats in usage_stats)
+        assert all(0 <= stats.cpu_max_usage <= 100 for stats in usage_stats)
+    assert machine_sizes.get_host_stats.cache_info().currsize == len(env_names)
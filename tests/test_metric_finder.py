@@ -0,0 +1,20 @@
+from metric_finder import QueryIndex, get_query_tokens, query_matches
+
+HYPHENATED = 'sum:commcare.corrupt-multimedia-submission.error.count{environment:icds}.as_count()'
+
+
+def test_hyphenated_metric_tokens():
+    metrics, tags = get_query_tokens(HYPHENATED)
+    assert metrics == {'commcare.corrupt-multimedia-submission.error.count'}
+    assert tags == {'environment', 'environment:icds'}
+
+
+def test_search_hyphenated_metric():
+    index = QueryIndex.build([
+        (HYPHENATED, 'Dashboard: A'),
+        ('avg:nginx.requests{environment:icds} by {host}', 'Dashboard: B'),
+    ])
+    assert index.search('commcare.corrupt-multimedia-submission.error.count') == [[HYPHENATED, 'Dashboard: A']]
+    assert index.search('commcare.corrupt-*') == [[HYPHENATED, 'Dashboard: A']]
+    assert index.search('submission.error.count') == []
+    assert query_matches('commcare.corrupt-multimedia-submission.error.count', HYPHENATED)
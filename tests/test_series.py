@@ -0,0 +1,36 @@
+import numpy as np
+
+from series import Series, SeriesStore, Table
+
+
+def test_argmax_ties_go_to_the_latest_point():
+    series = Series.from_pointlist([[1000, 5], [2000, 7], [3000, 7], [4000, None]])
+    assert series.argmax() == (3000, 7.0)
+    assert series.argmax(last=False) == (2000, 7.0)
+    assert Series(np.array([1000, 2000]), np.array([np.nan, np.nan])).argmax() is None
+
+
+def test_store_argmax_matches_series_argmax():
+    store = SeriesStore.from_pointlists([
+        (('a',), [[1000, 3], [2000, 3], [3000, 1]]),
+        (('b',), [[1000, None]]),
+        (('c',), [[1000, 2], [2000, 4], [3000, 4]]),
+    ])
+    assert store.argmax() == {('a',): (2000, 3.0), ('b',): None, ('c',): (3000, 4.0)}
+    for key, series in store.items():
+        assert store.argmax()[key] == series.argmax()
+
+
+def test_join_lines_series_up_by_timestamp():
+    a = Series.from_pointlist([[1000, 1.5], [2000, None], [3000, 3]])
+    b = Series.from_pointlist([[2000, 2], [3000, 4], [4000, 5]])
+    assert list(Table.join([a, b]).iter_rows(missing='-')) == [
+        ['1000', '1.5', '-'], ['2000', '-', '2.0'], ['3000', '3.0', '4.0'], ['4000', '-', '5.0'],
+    ]
+    assert list(Table.join([a, b], how='inner').iter_rows(value_format='%d', missing='-')) == [
+        ['2000', '-', '2'], ['3000', '3', '4'],
+    ]
+    assert list(Table.join([a, b], fill=0).iter_rows(lambda timestamps: ['t'] * len(timestamps), '%d')) == [
+        ['t', '1', '0'], ['t', '', '2'], ['t', '3', '4'], ['t', '0', '5'],
+    ]
+    assert list(Table.join([]).iter_rows()) == []
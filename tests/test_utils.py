@@ -0,0 +1,150 @@
+import pytest
+from datadog.api.exceptions import ApiError
+
+import utils
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    monkeypatch.setattr(utils, 'time', FakeClock())
+    monkeypatch.setattr(utils, '_replay_store', None)
+    scheduler = utils.RequestScheduler(max_retries=3)
+    monkeypatch.setattr(utils, '_scheduler', scheduler)
+    return scheduler
+
+
+def _responses(*responses):
+    responses = list(responses)
+    calls = []
+
+    def func(**kwargs):
+        calls.append(kwargs)
+        return responses.pop(0)
+    return func, calls
+
+
+def test_muted_connection_error_is_retried(scheduler):
+    func, calls = _responses(
+        {'errors': 'Could not request GET https://api.datadoghq.com/api/v1/query: Connection refused.'},
+        {'series': []},
+    )
+    assert utils.api_call(func, query='q') == {'series': []}
+    assert len(calls) == 2
+
+
+def test_muted_rate_limit_is_retried(scheduler):
+    func, calls = _responses(
+        {'errors': ['Rate limit of 300 requests in 3600 seconds reached. Please try again later.']},
+        {'series': []},
+    )
+    assert utils.api_call(func, query='q') == {'series': []}
+    assert len(calls) == 2
+    assert scheduler.limiter.rate is not None
+
+
+def test_unmuted_rate_limit_is_retried(scheduler):
+    responses = [ApiError({'errors': ['Rate limit exceeded']}), {'series': []}]
+
+    def func(**kwargs):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+    assert utils.api_call(func, query='q') == {'series': []}
+
+
+def test_muted_rate_limit_gives_up(scheduler):
+    func, calls = _responses(*[{'errors': ['Rate limit exceeded']}] * 4)
+    with pytest.raises(utils.RateLimited):
+        utils.api_call(func, query='q')
+    assert len(calls) == 4
+
+
+def test_error_body_is_not_returned(scheduler):
+    func, calls = _responses({'errors': ['Error parsing query']})
+    with pytest.raises(ApiError):
+        utils.api_call(func, query='q')
+    assert len(calls) == 1
+
+
+def test_split_batch_by_query_index():
+    queries = ['avg:a{*}', 'avg:b{*}, avg:c{*}', 'avg:d{*} + avg:e{*}']
+    response = {'series': [
+        {'query_index': 3, 'expression': 'avg:d{*} + avg:e{*}'},
+        {'query_index': 0, 'expression': 'avg:a{*}'},
+        {'query_index': 2, 'expression': 'avg:c{*}'},
+        {'query_index': 1, 'expression': 'avg:b{*}'},
+    ]}
+    split = utils._split_batch_response(queries, response)
+    assert [[series['query_index'] for series in result['series']] for result in split] == [[0], [2, 1], [3]]
+
+
+def test_split_batch_without_query_index():
+    queries = ['avg:a{*} by {host}', '100 * avg:b{*} / avg:c{*}']
+    # datadog rewrites formula expressions so they only match by position
+    by_expression = {'series': [
+        {'expression': 'avg:a{*} by {host}', 'scope': 'host:1'},
+        {'expression': 'avg:a{*} by {host}', 'scope': 'host:2'},
+        {'expression': '(100 * avg:b{*}) / avg:c{*}'},
+    ]}
+    assert utils._split_batch_response(queries, by_expression) is None
+    by_position = {'series': [{'expression': 'avg:a{host:1}'}, {'expression': '(100 * avg:b{*}) / avg:c{*}'}]}
+    split = utils._split_batch_response(queries, by_position)
+    assert [result['series'] for result in split] == [[by_position['series'][0]], [by_position['series'][1]]]
+
+
+def test_query_batch_sends_formulas_together(monkeypatch):
+    from icds_success import METRICS
+    from synthetic import SyntheticApi, SyntheticFleet
+    api = SyntheticApi(SyntheticFleet(hosts=2))
+    calls = []
+
+    def replay(func, args, kwargs):
+        calls.append(kwargs['query'])
+        return SyntheticApi.replay(api, func, args, kwargs)
+    monkeypatch.setattr(api, 'replay', replay)
+    monkeypatch.setattr(utils, '_replay_store', api)
+    monkeypatch.setattr(utils, '_query_cache', None)
+    monkeypatch.setattr(utils, '_warehouse', None)
+
+    queries = [
+        query.format(env='icds', **context)
+        for query, _, contexts in METRICS.values() if isinstance(query, str)
+        for context in contexts or [{}]
+    ]
+    batched = utils.query_batch(queries, 1577836800, 1577836800 + 86400 * 3, batch_size=10)
+    assert len(calls) == 1
+    for query, result in zip(queries, batched):
+        alone = utils.query_metric(query, 1577836800, 1577836800 + 86400 * 3)
+        assert [series['pointlist'] for series in result['series']] == \
+            [series['pointlist'] for series in alone['series']]
+
+
+@pytest.mark.parametrize('argv, cached, refresh', [
+    ([], True, False),
+    (['--synthetic', '5'], False, None),
+    (['--replay', 'fixtures'], False, None),
+    (['--record', 'fixtures'], True, True),
+    (['--no-cache'], False, None),
+])
+def test_query_cache_is_kept_apart_from_fake_responses(monkeypatch, tmpdir, argv, cached, refresh):
+    import argparse
+    for name in ('_replay_store', '_query_cache', '_warehouse', '_scheduler'):
+        monkeypatch.setattr(utils, name, getattr(utils, name))
+    parser = argparse.ArgumentParser()
+    utils.add_query_args(parser)
+    utils.configure_queries(parser.parse_args(argv + ['--cache-dir', str(tmpdir)]))
+    assert (utils._query_cache is not None) == cached
+    if cached:
+        assert utils._query_cache.refresh == refresh
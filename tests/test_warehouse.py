@@ -0,0 +1,59 @@
+from datetime import datetime
+
+import pytest
+
+import utils
+import warehouse
+from synthetic import SyntheticApi, SyntheticFleet
+
+DAY = 24 * 60 * 60
+START = 18262 * DAY  # 2020-01-01 00:00 UTC
+END = START + 28 * DAY  # exactly UTC midnight
+
+
+@pytest.fixture
+def synthetic(monkeypatch):
+    monkeypatch.setattr(utils, '_replay_store', SyntheticApi(SyntheticFleet(hosts=3)))
+    monkeypatch.setattr(utils, '_query_cache', None)
+    monkeypatch.setattr(utils, '_warehouse', None)
+
+
+def test_get_days_excludes_end():
+    assert list(warehouse.get_days(START, END)) == list(range(18262, 18262 + 28))
+    assert list(warehouse.get_days(START, END + 1)) == list(range(18262, 18262 + 29))
+    assert list(warehouse.get_days(START, START)) == [18262]
+
+
+@pytest.mark.parametrize('query, points', [
+    ('sum:nginx.requests{environment:icds}.as_count().rollup(sum, 86400)', 29),
+    ('max:system.mem.used{environment:icds}by{host}.rollup(max, 3600)', 673),
+    ('sum:nginx.requests{environment:icds}.rollup(sum, 3600), avg:nginx.requests{environment:icds}.rollup(avg, 3600)', 673),
+])
+def test_local_matches_datadog(synthetic, tmpdir, query, points):
+    store = warehouse.Warehouse(str(tmpdir))
+    list(warehouse.sync(store, [query], START - 7 * DAY, END + 7 * DAY))
+
+    start, end = datetime.utcfromtimestamp(START), datetime.utcfromtimestamp(END)
+    remote = utils.query_range(query, start, end, rollup=utils.get_rollup_interval(query))
+    local = store.query(query, START, END)
+    assert [len(series['pointlist']) for series in local['series']] == [points] * len(remote['series'])
+    assert [(series['scope'], series['pointlist']) for series in local['series']] == \
+        [(series['scope'], series['pointlist']) for series in remote['series']]
+
+
+@pytest.mark.parametrize('query, points', [
+    ('sum:nginx.requests{environment:icds}.as_count().rollup(sum, 86400)', 28),
+    ('max:system.mem.used{environment:icds}by{host}.rollup(max, 3600)', 672),
+    ('sum:system.disk.used{environment:icds,device:/opt/data}.rollup(avg, 2592000)', 2),
+])
+def test_query_the_range_that_was_synced(synthetic, tmpdir, query, points):
+    store = warehouse.Warehouse(str(tmpdir))
+    assert [fetched for _, _, fetched in warehouse.sync(store, [query], START, END)] == [28]
+
+    local = store.query(query, START, END)
+    assert {len(series['pointlist']) for series in local['series']} == {points}
+
+
+def test_query_without_rollup_is_missing(tmpdir):
+    with pytest.raises(warehouse.WarehouseMissing):
+        warehouse.Warehouse(str(tmpdir)).query('sum:nginx.requests{environment:icds}', START, END)